@@ -7,62 +7,115 @@ Javier Santacruz 04/06/2011
 """
 
 import os
+import json
+import stat
+import errno
 import shutil
 import random
-from lxml import objectify
+import bisect
+import codecs
+import hashlib
+import threading
+import Queue
+from collections import defaultdict, namedtuple, OrderedDict
+from urlparse import unquote
 from optparse import OptionParser
 
 
+_FORMATS_ = {}
+
+
+def register_format(name):
+    "Class decorator registering a playlist class in _FORMATS_ under name"
+    def register(klass):
+        _FORMATS_[name] = klass
+        return klass
+    return register
+
+
+def uri_to_path(location):
+    "Returns the path for a file:// uri. Other locations are left untouched"
+    if location.startswith('file://'):
+        return unquote(location[7:])
+    return location
+
+
 class PIterable(object):
-    "Base class for iterable playlists"
+    """Base class for iterable playlists
+    Subclasses implement tracks() as a generator of (title, path) tuples,
+    so every iteration streams the playlist file again from the start.
+    Titles are utf-8 strings, None for tracks without one in every format.
+    name selects a playlist within files holding several of them.
+    """
+
+    extensions = ()
 
-    def __init__(self, path):
-        "Base constructor, sets self.path"
+    def __init__(self, path, name=None):
+        "Base constructor, sets self.path and self.name"
         self.path = path
+        self.name = name
 
     def __iter__(self):
-        "Returns a new object to iterate with it"
-        klass = type(self)
-        return klass(self.path)
+        "Returns a new generator to iterate with it"
+        return self.tracks()
 
+    @classmethod
+    def sniff(cls, path, header):
+        "Returns True if the file looks like this format given its header"
+        return cls.ns in header
 
+    def tracks(self):
+        "Yields title, absolute_path for every item on the playlist"
+        raise NotImplementedError
+
+
+@register_format("xspf")
 class Xspf(PIterable):
-    "Iterate over a XSPF playlist file."
+    """Iterate over a XSPF playlist file.
+    The file is parsed incrementally, track by track, so memory use doesn't
+    depend on the size of the playlist.
+    """
 
     ns = "http://xspf.org/ns/0/"
+    extensions = ('.xspf',)
 
-    def __init__(self, path):
-        super(Xspf, self).__init__(path)
-        self.root = objectify.parse(path).getroot()
-        self.list = self.root.trackList.track[:]
-        self.index = 0
+    def tracks(self):
+        """Yields title, absolute_path for every track on the list
+        lxml is imported here, as the other formats don't need it"""
+        from lxml import etree
 
-    def next(self):
-        "Returns title, absolute_path for every item on the list"
-        if self.index == len(self.list):
-            raise StopIteration
+        track_tag = "{{{0}}}track".format(self.ns)
+        title_tag = "{{{0}}}title".format(self.ns)
+        location_tag = "{{{0}}}location".format(self.ns)
 
-        # get title and remove initial file:///
-        title = self.list[self.index].title.text.encode('utf-8')
-        path = self.list[self.index].location.text.encode('utf-8')[7:]
+        for event, elem in etree.iterparse(self.path, tag=track_tag):
+            title = elem.findtext(title_tag) or None
+            location = elem.findtext(location_tag) or ''
 
-        self.index += 1  # next track
+            # Free the parsed track and the already seen siblings
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
 
-        return title, path
+            yield (title and title.encode('utf-8'),
+                   uri_to_path(location.encode('utf-8')))
 
 
+@register_format("m3u")
 class M3u(PIterable):
     "Iterate over a M3U playlist file."
 
     ns = "#EXTM3U"
+    extensions = ('.m3u',)
 
-    def __init__(self, path):
-        super(M3u, self).__init__(path)
-        self.base_path = os.path.dirname(self.path)
-        self.file = open(self.path, "r")
+    def decode(self, line):
+        "Returns the line as it should be used for titles and paths"
+        return line
 
-    def next(self):
-        """Returns title, absolute_path for every item on the playlist.
+    def tracks(self):
+        """Yields title, absolute_path for every item on the playlist.
+        Files are read line by line. Paths are relative to the playlist.
+        Remote urls are ignored and a leading byte order mark skipped.
 
         M3u objects have the following structure:
 
@@ -70,44 +123,222 @@ class M3u(PIterable):
         #EXTINF:342,Author - Song Title
         ../Music/song.mp3
         """
+        base_path = os.path.dirname(self.path)
+        with open(self.path, "r") as mfile:
+            title = None
+            for number, line in enumerate(mfile):
+                if not number and line.startswith(codecs.BOM_UTF8):
+                    line = line[len(codecs.BOM_UTF8):]
+                line = self.decode(line.rstrip('\r\n'))
+                if line.startswith('#EXTINF:'):
+                    title = line.split(',', 1)[-1] or None  # get title
+                elif line and not line.startswith('#'):
+                    if '://' in line and not line.startswith('file://'):
+                        continue
+                    yield title, os.path.join(base_path, uri_to_path(line))
+                    title = None
+
+
+@register_format("m3u8")
+class M3u8(M3u):
+    """Iterate over a UTF-8 extended M3U playlist file.
+    Byte order marks are skipped and invalid UTF-8 sequences replaced.
+    """
 
-        # Find a #EXTINF line and a path line
-        line, line_prev = '#', ''
-        while line.startswith('#'):
-            line_prev = line
-            line = self.file.readline()
-            if not line:
-                raise StopIteration
+    bom = codecs.BOM_UTF8
+    extensions = ('.m3u8',)
 
-        title = line_prev.split(',', 1)[1]  # get title
-        path = os.path.join(self.base_path, line)[0:-1]
+    @classmethod
+    def sniff(cls, path, header):
+        "Returns True for M3U files with a byte order mark or .m3u8 extension"
+        return cls.ns in header and (header.startswith(cls.bom) or
+                                     path.lower().endswith(cls.extensions))
 
-        return title, path
+    def decode(self, line):
+        "Returns the line as valid UTF-8"
+        return line.decode('utf-8', 'replace').encode('utf-8')
 
 
-def detect_format(path):
-    """Autodetects the format of a playlist file
-    returns (m3u|xspf) or None if unkown
+@register_format("pls")
+class Pls(PIterable):
+    """Iterate over a PLS playlist file.
+
+    Pls objects have the following structure:
+
+    [playlist]
+    File1=../Music/song.mp3
+    Title1=Author - Song Title
+    Length1=342
+    NumberOfEntries=1
+    Version=2
     """
 
-    lfile = open(path, "r")
-    header = lfile.readline(200)
-    lfile.close()
+    ns = "[playlist]"
+    extensions = ('.pls',)
 
-    if M3u.ns in header:
-        return "m3u"
-    elif Xspf.ns in header:
-        return "xspf"
+    @classmethod
+    def sniff(cls, path, header):
+        "Returns True if the file looks like this format given its header"
+        return header.lstrip().lower().startswith(cls.ns)
 
-    return None
+    def tracks(self):
+        """Yields title, absolute_path for every item on the playlist.
+        Entries are expected to be grouped by number, so each one is yielded
+        as soon as the next one starts.
+        """
+        base_path = os.path.dirname(self.path)
+        entry, title, location = None, None, None
+        with open(self.path, "r") as pfile:
+            for line in pfile:
+                key, sep, value = line.strip().partition('=')
+                key = key.lower()
+                for field in ('file', 'title'):
+                    if key.startswith(field) and key[len(field):].isdigit():
+                        break
+                else:
+                    continue
+
+                number = int(key[len(field):])
+                if number != entry:
+                    if location:
+                        yield title, os.path.join(base_path,
+                                                  uri_to_path(location))
+                    entry, title, location = number, None, None
+
+                if field == 'file':
+                    location = value
+                else:
+                    title = value or None
+
+        if location:
+            yield title, os.path.join(base_path, uri_to_path(location))
+
+
+class DbPlaylist(PIterable):
+    """Base class for playlists stored in music players sqlite databases.
+    Subclasses define the tables identifying the database, and the queries
+    listing the playlist names and the (title, uri) for a playlist name.
+    sqlite3 is imported by each method, as the other formats don't need it.
+    """
+
+    ns = "SQLite format 3\x00"
+    extensions = ('.db',)
+    tables = ()
+    names_query = ""
+    tracks_query = ""
 
+    @classmethod
+    def sniff(cls, path, header):
+        "Returns True if the file is a database with the expected tables"
+        if not header.startswith(cls.ns):
+            return False
 
-_FORMATS_ = {"m3u": M3u, "xspf": Xspf}
+        import sqlite3
+        conn = sqlite3.connect(path)
+        try:
+            found = set(row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"))
+        except sqlite3.DatabaseError:
+            return False
+        finally:
+            conn.close()
+
+        return found.issuperset(cls.tables)
+
+    def playlists(self):
+        "Returns the names of the playlists in the database"
+        import sqlite3
+        conn = sqlite3.connect(self.path)
+        try:
+            return [row[0].encode('utf-8')
+                    for row in conn.execute(self.names_query)]
+        finally:
+            conn.close()
+
+    def tracks(self):
+        "Yields title, absolute_path for every track in the playlist"
+        import sqlite3
+        conn = sqlite3.connect(self.path)
+        try:
+            cursor = conn.execute(self.tracks_query,
+                                  (self.name.decode('utf-8'),))
+            for title, uri in cursor:
+                yield title and title.encode('utf-8'), uri_to_path(str(uri))
+        finally:
+            conn.close()
+
+
+@register_format("clementine")
+class ClementineDb(DbPlaylist):
+    "Iterate over a playlist in a Clementine database."
+
+    tables = ('songs', 'playlists', 'playlist_items')
+
+    names_query = "SELECT name FROM playlists ORDER BY name"
+
+    tracks_query = """
+    SELECT COALESCE(songs.title, playlist_items.title),
+           COALESCE(songs.filename, playlist_items.url)
+    FROM playlist_items
+    INNER JOIN playlists ON playlists.ROWID = playlist_items.playlist
+    LEFT JOIN songs ON playlist_items.type = 'Library'
+                   AND songs.ROWID = playlist_items.library_id
+    WHERE playlists.name = ?
+    ORDER BY playlist_items.ROWID;
+    """
 
 
-def get_playlist(path, pformat=None):
+@register_format("banshee")
+class BansheeDb(DbPlaylist):
+    "Iterate over a playlist in a Banshee database."
+
+    tables = ('CoreTracks', 'CorePlaylists', 'CorePlaylistEntries')
+
+    names_query = "SELECT Name FROM CorePlaylists ORDER BY Name"
+
+    tracks_query = """
+    SELECT CoreTracks.Title, CoreTracks.Uri
+    FROM CorePlaylistEntries
+    INNER JOIN CorePlaylists
+      ON CorePlaylists.PlaylistID = CorePlaylistEntries.PlaylistID
+    INNER JOIN CoreTracks
+      ON CoreTracks.TrackID = CorePlaylistEntries.TrackID
+    WHERE CorePlaylists.Name = ?
+    ORDER BY CorePlaylistEntries.ViewOrder, CorePlaylistEntries.EntryID;
+    """
+
+
+def detect_format(path, header_size=512):
+    """Autodetects the format of a playlist file
+    Only the first header_size bytes are read. Formats recognized by their
+    header are preferred, the file extension breaks ties and is used alone
+    when no header is recognized.
+    returns a _FORMATS_ key or None if unkown
+    """
+    with open(path, "rb") as lfile:
+        header = lfile.read(header_size)
+    ext = os.path.splitext(path)[1].lower()
+
+    formats = sorted(_FORMATS_.iteritems())
+    sniffed = [name for name, klass in formats if klass.sniff(path, header)]
+    for name in sniffed:
+        if ext in _FORMATS_[name].extensions:
+            return name
+
+    if sniffed:
+        return sniffed[0]
+
+    for name, klass in formats:
+        if ext in klass.extensions:
+            return name
+
+    return None
+
+
+def get_playlist(path, pformat=None, name=None):
     """Returns a Playlist object of the given format.
     "if pformat is not specified or None, format will be auto detected
+    name selects the playlist within databases
     """
     if pformat is None:
         pformat = detect_format(path)
@@ -117,11 +348,174 @@ def get_playlist(path, pformat=None):
         exit()
 
     if pformat not in _FORMATS_.keys():
-        print "Error: Unkown '{0}' playlist format." .format(options.format)
+        print "Error: Unkown '{0}' playlist format." .format(pformat)
         exit()
 
     # Create playlist and sync directory
-    return _FORMATS_[pformat](path)
+    playlist = _FORMATS_[pformat](path, name)
+
+    if isinstance(playlist, DbPlaylist) and name not in playlist.playlists():
+        print "Error: Missing or unknown --playlist. Available playlists: {0}"\
+                .format(", ".join(playlist.playlists()))
+        exit()
+
+    return playlist
+
+
+# Checked playlist entry. error is None for files ready to be sent
+Track = namedtuple('Track', 'path size inode error')
+
+
+class StatCache(object):
+    """Checks playlist entries, listing and resolving each directory once.
+    Entries in the same directory are checked against its cached listing,
+    so missing files don't cost a stat, and the directory realpath is
+    resolved a single time. Safe to use from several threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dirs = {}
+
+    def directory(self, dpath):
+        """Returns (realpath, names, error) for a directory
+        names is None when the directory couldn't be listed
+        """
+        with self.lock:
+            cached = self.dirs.get(dpath)
+
+        if cached is None:
+            try:
+                cached = (os.path.realpath(dpath),
+                          frozenset(os.listdir(dpath)), None)
+            except OSError, err:
+                reason = 'missing' if err.errno == errno.ENOENT\
+                        else 'unreadable'
+                cached = (dpath, None, reason)
+            with self.lock:
+                self.dirs[dpath] = cached
+
+        return cached
+
+    def check(self, path):
+        "Returns the Track for the file in path, resolving links"
+        dpath, name = os.path.split(os.path.abspath(path))
+        real_dir, names, reason = self.directory(dpath)
+        if names is None:
+            return Track(path, None, None, reason)
+        if name not in names:
+            return Track(path, None, None, 'missing')
+
+        real = os.path.join(real_dir, name)
+        try:
+            fstat = os.lstat(real)
+            if stat.S_ISLNK(fstat.st_mode):
+                real = os.path.realpath(real)
+                fstat = os.stat(real)
+        except OSError, err:
+            reason = 'missing' if err.errno == errno.ENOENT else 'unreadable'
+            return Track(real, None, None, reason)
+
+        if not stat.S_ISREG(fstat.st_mode):
+            return Track(real, None, fstat.st_ino, 'not a regular file')
+        if not os.access(real, os.R_OK):
+            return Track(real, fstat.st_size, fstat.st_ino, 'unreadable')
+
+        return Track(real, fstat.st_size, fstat.st_ino, None)
+
+
+_REAL_DIRS_ = {}  # directory -> its real path, see catalog_path
+
+
+# Copied as is in mp3hash.py, list.py and banshee-clementine.py, as each
+# script runs on its own: keep the three copies in step
+def catalog_path(path):
+    """Returns the key of path in the library catalog: its real path, in
+    utf-8, so every tool finds the same file under the same key.
+    Directories are resolved once, as a library has lots of files in each"""
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    directory, name = os.path.split(os.path.abspath(path))
+    if directory not in _REAL_DIRS_:
+        _REAL_DIRS_[directory] = os.path.realpath(directory)
+    path = os.path.join(_REAL_DIRS_[directory], name)
+    if os.path.islink(path):
+        path = os.path.realpath(path)
+    return path
+
+
+_CATALOG_CHUNK_ = 500  # paths looked up at once, sqlite allows up to 999
+
+
+def catalog_tracks(catalog, paths):
+    """Returns {path: Track} for the paths found in the catalog database
+    kept by mp3hash --scan, taking their size and inode from it instead of
+    stating them. Entries are as fresh as the last scan.
+    """
+    import sqlite3
+
+    keys = defaultdict(list)
+    for path in paths:
+        keys[catalog_path(path)].append(path)
+
+    tracks = {}
+    wanted = list(keys)
+    try:
+        conn = sqlite3.connect(catalog)
+        conn.text_factory = str
+        try:
+            for i in xrange(0, len(wanted), _CATALOG_CHUNK_):
+                chunk = wanted[i:i + _CATALOG_CHUNK_]
+                for path, size, inode in conn.execute(
+                        "SELECT path, size, inode FROM files WHERE path IN "
+                        "({0})".format(",".join("?" * len(chunk))), chunk):
+                    for entry in keys[path]:
+                        tracks[entry] = Track(path, size, inode, None)
+        finally:
+            conn.close()
+    except sqlite3.DatabaseError, err:
+        print "Warning: Couldn't read catalog {0}: {1}".format(catalog, err)
+
+    return tracks
+
+
+def preflight(paths, jobs=8, catalog=None):
+    """Resolves, stats and checks all playlist entries in parallel.
+    Entries in the catalog, if given, are taken from it. See catalog_tracks.
+    Prints a summary and the entries which can't be sent.
+    Returns the list of Track for every entry, in playlist order
+    """
+    from multiprocessing.pool import ThreadPool
+
+    known = catalog_tracks(catalog, paths) if catalog else {}
+    unknown = [path for path in paths if path not in known]
+
+    cache = StatCache()
+    pool = ThreadPool(jobs)
+    try:
+        known.update(zip(unknown, pool.map(cache.check, unknown,
+                                           chunksize=256)))
+    finally:
+        pool.close()
+        pool.join()
+
+    tracks = [known[path] for path in paths]
+
+    failed = [t for t in tracks if t.error is not None]
+    for track in failed:
+        print "Warning: Skipping {0}: {1}".format(track.path, track.error)
+
+    reasons = defaultdict(int)
+    for track in failed:
+        reasons[track.error] += 1
+
+    print "Checked {0} files: {1} ready ({2} bytes){3}".format(
+        len(tracks), len(tracks) - len(failed),
+        sum(t.size for t in tracks if t.error is None),
+        "".join(", {0} {1}".format(n, reason)
+                for reason, n in sorted(reasons.iteritems())))
+
+    return tracks
 
 
 def prefix_name(number, name, total):
@@ -144,20 +538,304 @@ def get_expected_names(local_files):
 
 
 def get_copy_names(local_files, expected_names, remote_names):
-    "Returns the files to be copied"
-    if options.force:
-        return local_files  # copy all of them
-
-    return [f for i, f in enumerate(local_files)
+    """Returns the files to be copied and the names they should get
+    remote_names are the names already holding the right file in remote
+    returns (copy_files, copy_names)
+    """
+    copy = [(f, expected_names[i]) for i, f in enumerate(local_files)
             if expected_names[i] not in remote_names]
 
+    return [f for f, n in copy], [n for f, n in copy]
+
+
+_HIDDEN_PREFIX_ = '.lists-'
+
+
+def list_remote(remote_dir):
+    "Returns the file names in remote, omitting the ones used by lists itself"
+    return [f for f in os.listdir(remote_dir)
+            if not f.startswith(_HIDDEN_PREFIX_)]
+
+
+def quick_digest(path, blocksize=65536):
+    """Returns a fast digest for a file
+    Only the size, the first and the last blocksize bytes are hashed.
+    """
+    size = os.path.getsize(path)
+    hasher = hashlib.sha1(str(size))
+    with open(path, 'rb') as ofile:
+        hasher.update(ofile.read(blocksize))
+        if size > blocksize:
+            ofile.seek(max(blocksize, size - blocksize))
+            hasher.update(ofile.read(blocksize))
+
+    return hasher.hexdigest()
+
+
+class Manifest(object):
+    """Persistent index of the files in a remote directory.
+    Stores {name: [size, mtime, digest]} so remote files aren't hashed again
+    while their size and modification time remain the same.
+    """
+
+    name = _HIDDEN_PREFIX_ + 'manifest'
+
+    def __init__(self, remote_dir):
+        self.remote_dir = remote_dir
+        self.path = os.path.join(remote_dir, self.name)
+        self.entries = {}
+        try:
+            with open(self.path, 'r') as mfile:
+                self.entries = json.load(mfile)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def digest(self, name):
+        "Returns the digest for a remote file, hashing it only if needed"
+        fpath = os.path.join(self.remote_dir, name)
+        fstat = os.stat(fpath)
+        entry = self.entries.get(name)
+        if entry and entry[0] == fstat.st_size and entry[1] == fstat.st_mtime:
+            return entry[2]
+
+        return self.update(name, quick_digest(fpath))
+
+    def update(self, name, digest):
+        "Records the digest for a remote file. Returns the digest"
+        fstat = os.stat(os.path.join(self.remote_dir, name))
+        self.entries[name] = [fstat.st_size, fstat.st_mtime, digest]
+        return digest
+
+    def rename(self, old, new):
+        "Moves the entry for old to new"
+        entry = self.entries.pop(old, None)
+        if entry is not None:
+            self.entries[new] = entry
+
+    def forget(self, name):
+        "Removes the entry for name"
+        self.entries.pop(name, None)
+
+    def save(self):
+        "Writes the manifest to remote, dropping entries for missing files"
+        present = set(list_remote(self.remote_dir))
+        entries = dict((k, v) for k, v in self.entries.iteritems()
+                       if k in present)
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as mfile:
+                json.dump(entries, mfile)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError), err:
+            print "Warning: Couldn't write manifest {0}: {1}"\
+                    .format(self.path, err)
+
+
+class Journal(object):
+    """Records the files being copied into a remote directory.
+    Files are written under a hidden partial name and renamed when complete,
+    so interrupted copies are never taken for finished ones. The journal
+    keeps {name: [source, size, mtime, offset]}, offset being the amount of
+    data known to be on disk, so interrupted copies can be resumed.
+    """
+
+    name = _HIDDEN_PREFIX_ + 'journal'
+    partial_prefix = _HIDDEN_PREFIX_ + 'partial-'
+
+    def __init__(self, remote_dir):
+        self.remote_dir = remote_dir
+        self.path = os.path.join(remote_dir, self.name)
+        self.entries = {}
+        try:
+            with open(self.path, 'r') as jfile:
+                self.entries = json.load(jfile)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def partial_path(self, name):
+        "Returns the path where name is written until complete"
+        return os.path.join(self.remote_dir, self.partial_prefix + name)
+
+    def cleanup(self, pending_names):
+        "Removes partial files and entries for names no longer pending"
+        pending_names = set(pending_names)
+        for fname in os.listdir(self.remote_dir):
+            name = fname[len(self.partial_prefix):]
+            if fname.startswith(self.partial_prefix)\
+                    and name not in pending_names:
+                try:
+                    os.remove(os.path.join(self.remote_dir, fname))
+                except OSError, err:
+                    print "Error: Couldn't remove {0} from {1}: {2}"\
+                            .format(fname, self.remote_dir, err)
+
+        for name in set(self.entries).difference(pending_names):
+            del self.entries[name]
+        self.save()
+
+    def resume_offset(self, name, src, verify_size=65536):
+        """Returns the offset to resume copying src as name from.
+        The partial file must come from the same unmodified source, and its
+        last verify_size bytes before the offset must match the source.
+        Returns 0 when the copy can't be resumed
+        """
+        entry = self.entries.get(name)
+        partial = self.partial_path(name)
+        if not entry or not os.path.exists(partial):
+            return 0
+
+        fstat = os.stat(src)
+        source, size, mtime, offset = entry
+        if source != src or size != fstat.st_size or mtime != fstat.st_mtime\
+                or os.path.getsize(partial) < offset:
+            return 0
+
+        start = max(0, offset - verify_size)
+        with open(src, 'rb') as sfile, open(partial, 'rb') as pfile:
+            sfile.seek(start)
+            pfile.seek(start)
+            if sfile.read(offset - start) != pfile.read(offset - start):
+                return 0
+
+        return offset
+
+    def checkpoint(self, name, src, offset):
+        "Records offset bytes of src as safely written to name"
+        fstat = os.stat(src)
+        self.entries[name] = [src, fstat.st_size, fstat.st_mtime, offset]
+        self.save()
+
+    def done(self, name):
+        "Forgets a completed file"
+        if self.entries.pop(name, None) is not None:
+            self.save()
+
+    def save(self):
+        "Writes the journal to remote, removing it when empty"
+        try:
+            if not self.entries:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                return
+
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as jfile:
+                json.dump(self.entries, jfile)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError), err:
+            print "Warning: Couldn't write journal {0}: {1}"\
+                    .format(self.path, err)
+
+
+def plan_sync(local_files, expected_names, remote_names, manifest,
+              verify=False, tracks=None):
+    """Decides what to do with each file comparing local and remote contents.
+    Files are matched by size first and by digest only when sizes agree.
+    If verify is set, files already in remote under the expected name are
+    checked too instead of trusting their name.
+    tracks maps local files to their Track, to avoid stating them again.
+    returns (present, moves, stale):
+        present - expected names already holding the right file
+        moves - [(remote_name, expected_name)] renames to perform in remote
+        stale - remote names to be replaced as their contents are wrong
+    """
+    remote = set(remote_names)
+    tracks = tracks or {}
+    sizes, digests = {}, {}
+
+    def local_size(i):
+        if i not in sizes:
+            track = tracks.get(local_files[i])
+            sizes[i] = track.size if track else\
+                    os.path.getsize(local_files[i])
+        return sizes[i]
+
+    def local_digest(i):
+        if i not in digests:
+            digests[i] = quick_digest(local_files[i])
+        return digests[i]
+
+    def remote_size(name):
+        return os.path.getsize(os.path.join(manifest.remote_dir, name))
+
+    present = set()
+    for i, name in enumerate(expected_names):
+        if name not in remote or name in present:
+            continue
+        if not verify or (remote_size(name) == local_size(i)
+                          and manifest.digest(name) == local_digest(i)):
+            present.add(name)
+
+    # Remote files whose contents could still be used somewhere else
+    candidates = defaultdict(list)
+    for name in remote - present:
+        candidates[remote_size(name)].append(name)
+
+    moves, moved = [], set()
+    for i, name in enumerate(expected_names):
+        if name in present or name in moved:
+            continue
+
+        for cand in candidates.get(local_size(i), ()):
+            if manifest.digest(cand) == local_digest(i):
+                moves.append((cand, name))
+                moved.add(name)
+                candidates[local_size(i)].remove(cand)
+                break
+
+    # Moved files overwrite whatever is under their new name
+    moved_away = set(cand for cand, name in moves)
+    stale = [name for name in set(expected_names).intersection(remote)
+             if name not in present and name not in moved
+             and name not in moved_away]
+
+    return present.union(moved), moves, stale
+
+
+def move_files(moves, remote_dir, manifest):
+    """Renames files within remote_dir.
+    Files are renamed to a temporary name first so swaps can't collide.
+    Returns the names of the files effectively moved
+    """
+    if moves:
+        print "Moving {0} files already in {1}".format(len(moves), remote_dir)
+
+    temps = []
+    for n, (old, new) in enumerate(moves):
+        tmp = "{0}tmp-{1}".format(_HIDDEN_PREFIX_, n)
+        try:
+            os.rename(os.path.join(remote_dir, old),
+                      os.path.join(remote_dir, tmp))
+        except OSError, err:
+            print "Error: Couldn't move {0} in {1}: {2}"\
+                    .format(old, remote_dir, err)
+        else:
+            manifest.rename(old, tmp)
+            temps.append((tmp, new))
+
+    moved = []
+    for tmp, new in temps:
+        try:
+            os.rename(os.path.join(remote_dir, tmp),
+                      os.path.join(remote_dir, new))
+        except OSError, err:
+            print "Error: Couldn't move {0} in {1}: {2}"\
+                    .format(new, remote_dir, err)
+        else:
+            manifest.rename(tmp, new)
+            moved.append(new)
+            print "Moved {0}/{1}: {2}".format(len(moved), len(moves), new)
+
+    return moved
+
 
 def delete_files(expected_names, remote_dir):
     """Deletes files in remote which aren't expected to be there
     Returns the name of files effectively deleted
     """
+    expected_names = set(expected_names)
     delete_list = [os.path.join(remote_dir, f)
-                   for f in os.listdir(remote_dir)
+                   for f in list_remote(remote_dir)
                    if f not in expected_names]
 
     print "Removing {0} files from {1}".format(len(delete_list), remote_dir)
@@ -190,16 +868,59 @@ def link(from_path, to_path):
         return True
 
 
-def copy(from_path, to_path):
-    "Wrapper around shutil.copy. Returns True/False on success/failure"
+def journaled_copy(from_path, to_path, journal, blocksize=1048576,
+                   checkpoint=16777216):
+    """Copies from_path to to_path through a partial file recorded in journal
+    Every checkpoint bytes the data is synced to disk and its offset saved,
+    so an interrupted copy resumes from there instead of starting over.
+    """
+    name = os.path.basename(to_path)
+    partial = journal.partial_path(name)
+    offset = journal.resume_offset(name, from_path)
+    if offset:
+        print "Resuming {0} from byte {1}".format(name, offset)
+
+    with open(from_path, 'rb') as sfile,\
+            open(partial, 'r+b' if offset else 'wb') as dfile:
+        sfile.seek(offset)
+        dfile.seek(offset)
+        dfile.truncate()
+        journal.checkpoint(name, from_path, offset)
+
+        unsynced = 0
+        for block in iter(lambda: sfile.read(blocksize), ''):
+            dfile.write(block)
+            offset += len(block)
+            unsynced += len(block)
+            if unsynced >= checkpoint:
+                dfile.flush()
+                os.fsync(dfile.fileno())
+                journal.checkpoint(name, from_path, offset)
+                unsynced = 0
+
+        dfile.flush()
+        os.fsync(dfile.fileno())
+
+    shutil.copymode(from_path, partial)
+    os.rename(partial, to_path)
+    journal.done(name)
+
+
+def copy(from_path, to_path, journal=None):
+    """Wrapper around shutil.copy. Returns True/False on success/failure
+    Copies through journaled_copy if a journal is given
+    """
     try:
-        shutil.copy(from_path, to_path)
+        if journal is None:
+            shutil.copy(from_path, to_path)
+        else:
+            journaled_copy(from_path, to_path, journal)
     except shutil.Error, err:
         print "Error: Couldn't copy {0} from {1} to {2}: {3}"\
                 .format(os.path.basename(from_path),
                         os.path.dirname(from_path), to_path, err)
         return False
-    except IOError, err:
+    except (IOError, OSError), err:
         print "Error: Couldn't copy {0} from {1} to {2}: {3}"\
         .format(os.path.basename(from_path), os.path.dirname(from_path),
                 to_path, err)
@@ -208,9 +929,12 @@ def copy(from_path, to_path):
     return True
 
 
-def send_files(copy_files, expected_names, remote_dir, dolink=False):
+def send_files(copy_files, expected_names, remote_dir, dolink=False,
+               manifest=None, journal=None):
     """Copies/Links files to remote dir as expected_name
     Links instead of copying the files if link is True
+    Records the digest of every sent file in manifest if given
+    Copies are resumable when a journal is given, see journaled_copy
     returns the number of files copied/linked
     """
     action = "Linking" if dolink else "Copying"
@@ -222,42 +946,349 @@ def send_files(copy_files, expected_names, remote_dir, dolink=False):
         if os.path.exists(dest):
             print "Warning: Destination {0} already exists".format(dest)
             continue
-        op_result = link(cfile, dest) if dolink else copy(cfile, dest)
+        op_result = link(cfile, dest) if dolink else\
+                copy(cfile, dest, journal)
         if op_result:
+            if manifest is not None:
+                manifest.update(expected_names[i], quick_digest(cfile))
             copied += 1
             print "{0} {1}/{2}: {3}".format(action, copied,
                                             len(copy_files), cfile)
     return copied
 
 
-def sync_dirs(local_files, remote_dir, opts):
-    """Copy a set files to a directory.
-    If delete is set, will remove files in remote which are not in local.
-    If link is set, will perform hard link instead of copy.
-    If force is set, will copy all files ignoring if they're already in remote.
-    """
-    if opts.cd:
-        # Maximize de number of files in the CD
-        # omit files until the result fit's into a CD big ones first
-        weighted_files = map(lambda f: (os.path.getsize(f) * 5, f), local_files)
-        weighted_files.sort(key=lambda f: f[0], reverse=True)  # biggers first
-        adder = lambda x, y: x[0] if isinstance(x, tuple) else x + y[0]
-        total_size = reduce(adder, weighted_files)
-
-        cdsize = 700 * 1024 * 1024  # in bytes
-        while total_size > cdsize:
-            size,f = weighted_files.pop()
-            print "Ommiting {0} to fit CD size".format(f)
-            local_files.remove(f)
-            total_size -= size
+# Target codec: (extension, encoder arguments)
+_CODECS_ = {'mp3': ('.mp3', ['-codec:a', 'libmp3lame']),
+            'ogg': ('.ogg', ['-codec:a', 'libvorbis']),
+            'opus': ('.opus', ['-codec:a', 'libopus']),
+            'aac': ('.m4a', ['-codec:a', 'aac'])}
+
+
+def encoder_command(src, dest, opts):
+    "Returns the encoder command line converting src into dest"
+    ext, codec_args = _CODECS_[opts.transcode]
+    return ([opts.encoder, '-v', 'error', '-nostdin', '-y', '-i', src, '-vn']
+            + codec_args + ['-b:a', opts.bitrate, dest])
+
+
+def cached_name(path, opts):
+    """Returns the path for the transcoded version of path in opts.cache
+    The cache is content-addressed: the key is the digest of the source
+    contents and the encoder command, so the same track is never
+    transcoded twice with the same settings, whatever its path.
+    """
+    ext, codec_args = _CODECS_[opts.transcode]
+    key = hashlib.sha1(quick_digest(path))
+    key.update(repr(encoder_command('', '', opts)))
+    key = key.hexdigest()
+    name = os.path.splitext(os.path.basename(path))[0] + ext
+    return os.path.join(opts.cache, key[:2], key, name)
+
+
+def encode(job):
+    """Runs an encoder command writing tmp, which is renamed to dest on success
+    Process pool worker: takes (src, tmp, dest, command)
+    returns (src, error) with error being None on success
+    """
+    import subprocess
+
+    src, tmp, dest, command = job
+    try:
+        if not os.path.isdir(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        with open(os.devnull, 'w') as devnull:
+            process = subprocess.Popen(command, stdout=devnull,
+                                       stderr=subprocess.PIPE)
+            err = process.communicate()[1]
+        if process.returncode != 0:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return src, err.strip() or "encoder exited with {0}"\
+                    .format(process.returncode)
+        os.rename(tmp, dest)
+    except OSError, err:
+        return src, str(err)
+
+    return src, None
+
+
+def transcode_files(local_files, opts, tracks):
+    """Converts local files with extensions in opts.transcode_formats to the
+    opts.transcode codec. Conversions run in a process pool and are kept in
+    the opts.cache directory, only the ones missing there are encoded.
+    tracks maps every local file to its Track.
+    Returns (files, tracks) with converted files replacing their sources.
+    Files which couldn't be converted are omitted. Sources with the same
+    contents and name share their cached file, and it's only encoded once.
+    multiprocessing is imported here, as only transcoding needs it.
+    """
+    import multiprocessing
+
+    formats = set('.' + f.strip().lower().lstrip('.')
+                  for f in opts.transcode_formats.split(','))
+    convert = lambda path: os.path.splitext(path)[1].lower() in formats
+
+    targets = dict((path, cached_name(path, opts))
+                   for path in local_files if convert(path))
+
+    jobs, queued, cached = [], set(), 0
+    for src, dest in sorted(targets.iteritems()):
+        if dest in queued:
+            continue
+        if os.path.exists(dest):
+            cached += 1
+            continue
+        queued.add(dest)
+        # Sources with the same contents share the directory, not the name
+        tmp = os.path.join(os.path.dirname(dest), "{0}encoding-{1}-{2}".format(
+            _HIDDEN_PREFIX_, os.getpid(), os.path.basename(dest)))
+        jobs.append((src, tmp, dest, encoder_command(src, tmp, opts)))
+
+    print "Transcoding {0} files to {1}, {2} already in cache"\
+            .format(len(jobs), opts.transcode, cached)
+
+    if jobs:
+        pool = multiprocessing.Pool()
+        failed = set()
+        try:
+            done = 0
+            for src, err in pool.imap_unordered(encode, jobs):
+                if err is not None:
+                    print "Error: Couldn't transcode {0}: {1}".format(src, err)
+                    failed.add(targets[src])
+                    continue
+                done += 1
+                print "Transcoded {0}/{1}: {2}".format(done, len(jobs), src)
+        finally:
+            pool.close()
+            pool.join()
+
+        targets = dict((src, dest) for src, dest in targets.iteritems()
+                       if dest not in failed)
+
+    files, new_tracks = [], {}
+    for path in local_files:
+        if path in targets:
+            path = targets[path]
+            fstat = os.stat(path)
+            new_tracks[path] = Track(path, fstat.st_size, fstat.st_ino, None)
+        elif convert(path):
+            continue  # couldn't be converted
+        else:
+            new_tracks[path] = tracks[path]
+        files.append(path)
+
+    return files, new_tracks
+
+
+_SIZE_UNITS_ = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+                'T': 1024 ** 4}
+
+_CD_SIZE_ = 700 * 1024 ** 2  # in bytes
+
+
+def parse_size(text):
+    """Returns the number of bytes for a size like 700M, 4G or 4.7G
+    >>> parse_size('700M')
+    734003200
+    >>> parse_size('1.5K')
+    1536
+    """
+    text = text.strip().upper().rstrip('B').rstrip('I')
+    unit = text[-1:] if text[-1:] in _SIZE_UNITS_ else ''
+    size = int(float(text[:len(text) - len(unit)]) * _SIZE_UNITS_[unit])
+    if size <= 0:
+        raise ValueError("size should be positive: {0}".format(text))
+
+    return size
+
+
+def improve_packing(sizes, chosen, capacity):
+    """Grows the space used by the chosen items without exceeding capacity
+    Unchosen items fitting in the free space are added, biggest first, then
+    every chosen item is exchanged by the biggest unchosen one fitting in
+    the free space. Smallest chosen items go first, having the most room.
+    Returns the improved list of chosen indices
+    """
+    taken = set(chosen)
+    rest = sorted((i for i in xrange(len(sizes)) if i not in taken),
+                  key=sizes.__getitem__)
+    rest_sizes = [sizes[i] for i in rest]
+    total = sum(sizes[i] for i in chosen)
+    skip = {}  # rest positions already used, pointing to the next to try
+
+    def find(pos):
+        "Returns the first unused rest position <= pos, or -1"
+        path = []
+        while pos in skip:
+            path.append(pos)
+            pos = skip[pos]
+        for p in path:
+            skip[p] = pos
+        return pos
+
+    chosen = sorted(chosen, key=sizes.__getitem__)
+    pos = find(bisect.bisect_right(rest_sizes, capacity - total) - 1)
+    while pos >= 0:
+        total += rest_sizes[pos]
+        chosen.append(rest[pos])
+        skip[pos] = pos - 1
+        pos = find(bisect.bisect_right(rest_sizes, capacity - total) - 1)
+
+    for n, i in enumerate(chosen):
+        pos = find(bisect.bisect_right(rest_sizes, sizes[i] +
+                                       capacity - total) - 1)
+        if pos < 0 or rest_sizes[pos] <= sizes[i]:
+            continue
+        total += rest_sizes[pos] - sizes[i]
+        chosen[n] = rest[pos]
+        skip[pos] = pos - 1
+
+    return sorted(chosen)
+
+
+def pack_tracks(sizes, capacity):
+    """Returns the indices of the largest number of items fitting capacity
+    The smallest items are taken first, which gives the maximum count. The
+    used space is then grown keeping the count, see improve_packing.
+    """
+    total, chosen = 0, []
+    for i in sorted(xrange(len(sizes)), key=sizes.__getitem__):
+        if total + sizes[i] > capacity:
+            break
+        total += sizes[i]
+        chosen.append(i)
+
+    return improve_packing(sizes, chosen, capacity)
+
+
+def pack_bytes(sizes, capacity, unit=None):
+    """Returns the indices of the items filling the most of capacity
+    Solves the subset sum problem with dynamic programming over the sums,
+    using a python integer as a bitset. Sizes are rounded up to unit, so
+    the solution always fits, and the space lost by rounding is recovered
+    afterwards with improve_packing. By default unit is chosen to keep the
+    number of possible sums around 2**16.
+    who[s] holds the first item which made s reachable, so the solution is
+    rebuilt following who[s - size[who[s]]], which is always an earlier item.
+    """
+    if sum(sizes) <= capacity:
+        return range(len(sizes))
+
+    if unit is None:
+        unit = max(1, capacity >> 16)
+
+    limit = capacity // unit
+    weights = [-(-size // unit) for size in sizes]  # rounded up
+    mask = (1 << (limit + 1)) - 1
+    reach, who = 1, {}
+    for i, weight in enumerate(weights):
+        if weight > limit:
+            continue
+
+        new = (reach << weight) & mask & ~reach
+        reach |= new
+        while new:
+            low = new & -new
+            who[low.bit_length() - 1] = i
+            new ^= low
+
+        if reach >> limit:  # capacity completely filled
+            break
+
+    # Empty items don't take any room
+    chosen = [i for i, weight in enumerate(weights) if not weight]
+    total = reach.bit_length() - 1
+    while total:
+        i = who[total]
+        chosen.append(i)
+        total -= weights[i]
+
+    return improve_packing(sizes, chosen, capacity)
+
+
+_PACKERS_ = {'tracks': pack_tracks, 'bytes': pack_bytes}
+
+
+def pack_volumes(sizes, capacity, volumes=1, maximize='tracks'):
+    """Distributes items along volumes of the given capacity.
+    Each volume is filled in turn with the items left by the previous ones.
+    Returns a list with the list of item indices for each volume.
+    """
+    packer = _PACKERS_[maximize]
+    left = range(len(sizes))
+    packed = []
+    for n in xrange(volumes):
+        chosen = [left[i] for i in packer([sizes[i] for i in left], capacity)]
+        packed.append(chosen)
+        chosen = set(chosen)
+        left = [i for i in left if i not in chosen]
+        if not left:
+            break
+
+    return packed
+
+
+def fit_capacity(local_files, opts, tracks):
+    """Splits local_files in volumes fitting in opts.capacity bytes.
+    tracks maps every local file to its Track.
+    Files which don't fit in any volume are omitted.
+    Returns a list of file lists, keeping the playlist order.
+    """
+    sizes = [tracks[f].size for f in local_files]
+    packed = pack_volumes(sizes, opts.capacity, opts.volumes, opts.maximize)
+
+    omitted = set(xrange(len(local_files))).difference(*packed)
+    for i in sorted(omitted):
+        print "Omitting {0} to fit {1} bytes".format(local_files[i],
+                                                     opts.capacity)
+
+    for n, volume in enumerate(packed):
+        print "Volume {0}: {1} files, {2} of {3} bytes".format(
+            n + 1, len(volume), sum(sizes[i] for i in volume), opts.capacity)
+
+    return [[local_files[i] for i in volume] for volume in packed]
+
+
+# Pending work for a remote directory once it's been planned
+SyncPlan = namedtuple('SyncPlan', 'remote_dir copy_files copy_names manifest '
+                      'journal moved deleted')
 
+
+def prepare_dir(local_files, remote_dir, opts, tracks=None):
+    """Leaves remote_dir ready to receive the files it lacks.
+    Renames reusable files, replaces stale ones and deletes the undesired.
+    Returns the SyncPlan with the files still to be sent.
+    """
     # Obtain file names in order to compare file subsets
+    local_files = list(local_files)
     if opts.shuffle:
         random.shuffle(local_files)
 
     local_names = [os.path.basename(f) for f in local_files]  # local names
     expected_names = get_expected_names(local_names)  # what sould be in remote
-    remote_names = os.listdir(remote_dir)             # what is in remote
+    remote_names = list_remote(remote_dir)            # what is in remote
+
+    # Reuse what is already in remote, renaming it if needed
+    manifest = Manifest(remote_dir)
+    present, moves, stale = plan_sync(local_files, expected_names,
+                                      remote_names, manifest, opts.force,
+                                      tracks)
+    moved = move_files(moves, remote_dir, manifest)
+    present.difference_update(name for cand, name in moves
+                              if name not in moved)
+
+    # Files with the expected name but the wrong contents will be replaced
+    for name in stale:
+        print "Replacing {0} which differs in {1}".format(name, remote_dir)
+        try:
+            os.remove(os.path.join(remote_dir, name))
+        except OSError, err:
+            print "Error: Couldn't remove {0} from {1}: {2}"\
+                    .format(name, remote_dir, err)
+            present.add(name)
+        else:
+            manifest.forget(name)
 
     # Remove undesired files
     deleted = 0
@@ -265,48 +1296,257 @@ def sync_dirs(local_files, remote_dir, opts):
         deleted = delete_files(expected_names, remote_dir)
 
     # Paths to be copied to remote
-    copy_files = get_copy_names(local_files, expected_names, remote_names)
+    copy_files, copy_names = get_copy_names(local_files, expected_names,
+                                            present)
 
     # Warn about already present files which are being skipped
-    if not opts.force:
-        for f in set(remote_names).intersection(set(expected_names)):
-            print "Skipping {0} which is already in {1}"\
-                    .format(os.path.basename(f), remote_dir)
+    for f in present.intersection(remote_names):
+        print "Skipping {0} which is already in {1}".format(f, remote_dir)
 
-    # Copy/Link files to remote directory
-    copied = send_files(copy_files, expected_names, remote_dir, opts.link)
+    # Interrupted copies of files no longer wanted are useless
+    journal = Journal(remote_dir)
+    journal.cleanup(copy_names)
+
+    return SyncPlan(remote_dir, copy_files, copy_names, manifest, journal,
+                    moved, deleted)
+
+
+def finish_dir(plan, copied, opts):
+    "Saves the manifest for a synced directory and prints a summary"
+    plan.manifest.save()
     action = "Linking" if opts.link else "Copying"
 
-    print "{0} complete: {1} files copied, {2} files removed"\
-            .format(action, copied, deleted)
+    print "{0} complete in {1}: {2} files copied, {3} files moved, "\
+            "{4} files removed".format(action, plan.remote_dir, copied,
+                                       len(plan.moved), plan.deleted)
+
+
+def sync_dirs(local_files, remote_dir, opts, tracks=None):
+    """Copy a set files to a directory.
+    tracks maps local files to their Track, as returned by preflight.
+    If delete is set, will remove files in remote which are not in local.
+    If link is set, will perform hard link instead of copy.
+    If force is set, will check the contents of the files already in remote
+    instead of trusting their names.
+    Files already in remote under another name are renamed instead of copied.
+    """
+    plan = prepare_dir(local_files, remote_dir, opts, tracks)
+
+    # Copy/Link files to remote directory
+    copied = send_files(plan.copy_files, plan.copy_names, remote_dir,
+                        opts.link, plan.manifest, plan.journal)
+    finish_dir(plan, copied, opts)
+
+
+class DeviceWriter(threading.Thread):
+    """Writes files into a device fed from a bounded queue of messages:
+        ('open', src, dests) - starts writing copies of src to dests paths
+        ('data', block) - appends block to the current files
+        ('close',) - finishes the current files
+        ('abort',) - discards the current files
+        None - stops the thread
+    Files are written under their Journal partial name and renamed when
+    complete. Every finished file is appended to self.written as (src, dest).
+    """
+
+    def __init__(self, maxblocks=16):
+        super(DeviceWriter, self).__init__()
+        self.daemon = True
+        self.queue = Queue.Queue(maxblocks)
+        self.written = []
+
+    def put(self, *message):
+        "Queues a message, waiting if the device is behind"
+        self.queue.put(message or None)
+
+    def run(self):
+        src, dfiles = None, {}
+        for message in iter(self.queue.get, None):
+            if message[0] == 'open':
+                src, dfiles = message[1], {}
+                for dest in message[2]:
+                    if os.path.exists(dest):
+                        print "Warning: Destination {0} already exists"\
+                                .format(dest)
+                        continue
+                    try:
+                        dfiles[dest] = open(self.partial_path(dest), 'wb')
+                    except IOError, err:
+                        self.failed(src, dest, err)
+                continue
+
+            for dest, dfile in dfiles.items():
+                try:
+                    if message[0] == 'data':
+                        dfile.write(message[1])
+                        continue
+
+                    dfile.close()
+                    if message[0] == 'close':
+                        shutil.copymode(src, dfile.name)
+                        os.rename(dfile.name, dest)
+                        self.written.append((src, dest))
+                    else:
+                        os.remove(dfile.name)
+                except (IOError, OSError), err:
+                    self.failed(src, dest, err)
+                    dfile.close()
+                    del dfiles[dest]
+
+    @staticmethod
+    def partial_path(dest):
+        "Returns the path where dest is written until complete"
+        return os.path.join(os.path.dirname(dest),
+                            Journal.partial_prefix + os.path.basename(dest))
+
+    @staticmethod
+    def failed(src, dest, err):
+        "Reports a file which couldn't be written"
+        print "Error: Couldn't copy {0} to {1}: {2}"\
+                .format(os.path.basename(src), dest, err)
+
+
+def fan_out(sources, remote_dirs, dolink=False, blocksize=1048576):
+    """Sends every source file to its destinations reading it only once.
+    sources maps each source path to a list of (device, name), device
+    being an index in remote_dirs. Each device is written by its own
+    DeviceWriter thread so they all progress at the same time.
+    Returns a list with the names sent to each device
+    """
+    sent = [[] for remote_dir in remote_dirs]
+    action = "Linked" if dolink else "Read"
+
+    writers = []
+    if not dolink:
+        writers = [DeviceWriter() for remote_dir in remote_dirs]
+        for writer in writers:
+            writer.start()
+
+    for n, (src, dests) in enumerate(sources.iteritems()):
+        paths = defaultdict(list)
+        for device, name in dests:
+            paths[device].append(os.path.join(remote_dirs[device], name))
+
+        if dolink:
+            for device, path in ((d, p) for d in paths for p in paths[d]):
+                if os.path.exists(path):
+                    print "Warning: Destination {0} already exists"\
+                            .format(path)
+                elif link(src, path):
+                    sent[device].append(os.path.basename(path))
+        else:
+            for device in paths:
+                writers[device].put('open', src, paths[device])
+            end = 'close'
+            try:
+                with open(src, 'rb') as sfile:
+                    for block in iter(lambda: sfile.read(blocksize), ''):
+                        for device in paths:
+                            writers[device].put('data', block)
+            except IOError, err:
+                print "Error: Couldn't read {0}: {1}".format(src, err)
+                end = 'abort'
+            for device in paths:
+                writers[device].put(end)
+
+        print "{0} {1}/{2} for {3} directories: {4}".format(
+            action, n + 1, len(sources), len(paths), src)
+
+    for device, writer in enumerate(writers):
+        writer.put()
+        writer.join()
+        sent[device] = [os.path.basename(dest) for src, dest in writer.written]
+
+    return sent
+
+
+def sync_many(targets, opts, tracks=None):
+    """Copy files to several directories at once.
+    targets is a list of (local_files, remote_dir). Each directory is
+    planned on its own, as in sync_dirs, but every source file is read only
+    once and streamed to all the directories lacking it concurrently.
+    """
+    plans = [prepare_dir(local_files, remote_dir, opts, tracks)
+             for local_files, remote_dir in targets]
+
+    sources = OrderedDict()
+    for device, plan in enumerate(plans):
+        for src, name in zip(plan.copy_files, plan.copy_names):
+            sources.setdefault(src, []).append((device, name))
+
+    action = "Linking" if opts.link else "Copying"
+    print "{0} {1} files to {2} directories".format(action, len(sources),
+                                                    len(plans))
+    sent = fan_out(sources, [plan.remote_dir for plan in plans], opts.link)
+
+    # Digests are computed once per source file for all the manifests
+    digests = {}
+    for device, plan in enumerate(plans):
+        sources_of = dict((name, src) for src, name in
+                          zip(plan.copy_files, plan.copy_names))
+        for name in sent[device]:
+            src = sources_of[name]
+            if src not in digests:
+                digests[src] = quick_digest(src)
+            plan.manifest.update(name, digests[src])
+        finish_dir(plan, len(sent[device]), opts)
 
 
 def main():
 
     pl_path = args[0]
-    remote_dir = args[1]
-
-    if options.nocreate and not os.path.exists(remote_dir):
-        print "Error: {0} doesn't exists.".format(remote_dir)
-        exit()
+    remote_dirs = args[1:]
+
+    # Check every file before touching the remote directories
+    playlist = get_playlist(pl_path, options.format, options.playlist)
+    tracks = [t for t in preflight([path for title, path in playlist],
+                                   options.jobs, options.catalog)
+              if t.error is None]
+    files = [t.path for t in tracks]
+    tracks = dict((t.path, t) for t in tracks)
+
+    if options.transcode:
+        files, tracks = transcode_files(files, options, tracks)
+
+    for remote_dir in remote_dirs:
+        if options.nocreate and not os.path.exists(remote_dir):
+            print "Error: {0} doesn't exists.".format(remote_dir)
+            exit()
 
-    if not options.nocreate and not os.path.exists(remote_dir):
-        try:
-            os.mkdir(remote_dir)
-        except OSError:
-            print "Error: {0} doesn't exists and couldn't be created."\
-                .format(remote_dir)
+        if not options.nocreate and not os.path.exists(remote_dir):
+            try:
+                os.mkdir(remote_dir)
+            except OSError:
+                print "Error: {0} doesn't exists and couldn't be created."\
+                    .format(remote_dir)
+                exit()
+
+        if not os.path.isdir(remote_dir):
+            print "Error: {0} doesn't exists or is not a directory."\
+                    .format(remote_dir)
             exit()
 
-    if not os.path.isdir(remote_dir):
-        print "Error: {0} doesn't exists or is not a directory."\
-                .format(remote_dir)
-        exit()
+    volumes = fit_capacity(files, options, tracks) if options.capacity\
+            else [files]
+
+    # One subdirectory per volume
+    targets = []
+    for remote_dir in remote_dirs:
+        if len(volumes) == 1:
+            targets.append((volumes[0], remote_dir))
+            continue
 
-    playlist = get_playlist(pl_path, options.format)
-    files = [os.path.realpath(f[1]) for f in playlist]
+        for n, volume in enumerate(volumes):
+            volume_dir = os.path.join(remote_dir,
+                                      str(n + 1).zfill(len(str(len(volumes)))))
+            if not os.path.isdir(volume_dir):
+                os.mkdir(volume_dir)
+            targets.append((volume, volume_dir))
 
-    sync_dirs(files, remote_dir, options)
+    if len(targets) == 1:
+        sync_dirs(targets[0][0], targets[0][1], options, tracks)
+    else:
+        sync_many(targets, options, tracks)
 
 
 if __name__ == "__main__":
@@ -319,7 +1559,8 @@ if __name__ == "__main__":
 
     parser.add_option("-f", "--force", dest="force",
                       action="store_true", default=False,
-                      help="Force copy. Doesn't skip already existing files.")
+                      help="Check contents of files already in the directory "
+                      "instead of skipping them by name.")
 
     parser.add_option("-l", "--link", dest="link",
                       action="store_true", default=False,
@@ -344,23 +1585,78 @@ if __name__ == "__main__":
 
     parser.add_option("-7", "--cd", dest="cd",
                       action="store_true", default=False,
-                      help="Limits the list size to 700MiB")
+                      help="Limits the list size to 700MiB. "
+                      "Like --capacity 700M")
+
+    parser.add_option("-C", "--capacity", dest="capacity",
+                      action="store", default=None,
+                      help="Limits the list size to fit SIZE bytes. "
+                      "Accepts K, M, G suffixes: 4G, 700M")
+
+    parser.add_option("-x", "--maximize", dest="maximize",
+                      action="store", default="tracks",
+                      help="What to maximize when limiting the list size "
+                      "(tracks|bytes). Default tracks.")
+
+    parser.add_option("-V", "--volumes", dest="volumes",
+                      action="store", type="int", default=1,
+                      help="Split the list along N volumes of --capacity "
+                      "size, in numbered subdirectories.")
 
     parser.add_option("-t", "--format", dest="format",
                       action="store", default=None,
-                      help="Select format (m3u|xspf). Autodetects by default.")
+                      help="Select format ({0}). Autodetects by default."
+                      .format("|".join(sorted(_FORMATS_))))
+
+    parser.add_option("-j", "--jobs", dest="jobs",
+                      action="store", type="int", default=8,
+                      help="Number of files checked in parallel before "
+                      "syncing. Default 8.")
+
+    parser.add_option("-T", "--transcode", dest="transcode",
+                      action="store", default=None,
+                      help="Convert files to a codec ({0}) before sending "
+                      "them.".format("|".join(sorted(_CODECS_))))
+
+    parser.add_option("-b", "--bitrate", dest="bitrate",
+                      action="store", default="192k",
+                      help="Bitrate for --transcode. Default 192k.")
+
+    parser.add_option("--transcode-formats", dest="transcode_formats",
+                      action="store", default="flac",
+                      help="Comma separated extensions of the files to "
+                      "convert with --transcode. Default flac.")
+
+    parser.add_option("--encoder", dest="encoder",
+                      action="store", default="ffmpeg",
+                      help="Encoder program for --transcode. Default ffmpeg.")
 
-    parser.set_usage("Usage: [options] playlist directory")
+    parser.add_option("--cache", dest="cache",
+                      action="store",
+                      default=os.path.expanduser("~/.cache/lists"),
+                      help="Directory keeping transcoded files. "
+                      "Default ~/.cache/lists")
+
+    parser.add_option("--catalog", dest="catalog",
+                      action="store", default=None,
+                      help="Library catalog kept by mp3hash --scan. Files "
+                      "in it aren't checked again.")
+
+    parser.add_option("-p", "--playlist", dest="playlist",
+                      action="store", default=None,
+                      help="Playlist name when reading from a Clementine or "
+                      "Banshee database.")
+
+    parser.set_usage("Usage: [options] playlist directory [directory ..]")
 
     (options, args) = parser.parse_args()
 
     # Check arguments
     errors = (("Error: Missing playlist and directory paths."),
-               ("Error: Missing directory paths."),
-               ("Error: Too many arguments."))
+               ("Error: Missing directory paths."))
 
-    if len(args) != 2:
-        print errors[len(args) if len(args) < 3 else 2]
+    if len(args) < 2:
+        print errors[len(args)]
         print parser.print_help()
         exit(1)
 
@@ -368,9 +1664,36 @@ if __name__ == "__main__":
         options.numbered = True
         options.shuffle = True
 
+    if options.capacity:
+        try:
+            options.capacity = parse_size(options.capacity)
+        except ValueError:
+            print "Error: Invalid size for --capacity: {0}"\
+                    .format(options.capacity)
+            exit(1)
+    elif options.cd:
+        options.capacity = _CD_SIZE_
+
+    if options.maximize not in _PACKERS_:
+        print "Error: Unknown --maximize value: {0}".format(options.maximize)
+        exit(1)
+
+    if options.transcode and options.transcode not in _CODECS_:
+        print "Error: Unknown --transcode codec: {0}".format(options.transcode)
+        exit(1)
+
+    if options.volumes < 1:
+        print "Error: --volumes should be a positive integer"
+        exit(1)
+
     if not os.path.isfile(args[0]):
         print "Error: playlist doesn't exist or isn't a file: {0}. Exiting."\
                 .format(args[0])
         exit(1)
 
+    if options.catalog and not os.path.isfile(options.catalog):
+        print "Error: catalog doesn't exist or isn't a file: {0}. Exiting."\
+                .format(options.catalog)
+        exit(1)
+
     main()
@@ -27,9 +27,12 @@ import sys
 import struct
 import hashlib
 import logging
+import sqlite3
 from optparse import OptionParser
 
 _LOGGING_FMT_ = '%(asctime)s %(levelname)-8s %(message)s'
+_EXTENSIONS_ = ('.mp3', '.ogg', '.flac', '.m4a', '.wma', '.wav')  # scanned
+_BATCH_SIZE_ = 1000  # files stored in the catalog at once while scanning
 
 
 def error(msg, is_exit=True):
@@ -248,6 +251,161 @@ def mp3hash(path, alg='sha1', maxbytes=None):
         return TaggedFile(path).hash(maxbytes=maxbytes)
 
 
+_REAL_DIRS_ = {}  # directory -> its real path, see catalog_path
+
+
+# Copied as is in mp3hash.py, list.py and banshee-clementine.py, as each
+# script runs on its own: keep the three copies in step
+def catalog_path(path):
+    """Returns the key of path in the library catalog: its real path, in
+    utf-8, so every tool finds the same file under the same key.
+    Directories are resolved once, as a library has lots of files in each"""
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    directory, name = os.path.split(os.path.abspath(path))
+    if directory not in _REAL_DIRS_:
+        _REAL_DIRS_[directory] = os.path.realpath(directory)
+    path = os.path.join(_REAL_DIRS_[directory], name)
+    if os.path.islink(path):
+        path = os.path.realpath(path)
+    return path
+
+
+def file_stamp(fstat):
+    "Returns (inode, size, mtime) from a stat result, which tell a change"
+    return fstat.st_ino, fstat.st_size, fstat.st_mtime
+
+
+class Catalog(object):
+    """Library catalog: a sqlite database with the path, inode, size, mtime,
+    music limits and audio digest of every file scanned. lists reads it
+    instead of stating the files and music-bd adds the players stats.
+    Entries are trusted while their file keeps the same inode, size and
+    mtime, so only new or changed files are read again.
+    """
+
+    _SCHEMA = """
+    CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, mtime REAL,
+        startbyte INTEGER, endbyte INTEGER, algorithm TEXT, digest TEXT);
+    CREATE INDEX IF NOT EXISTS files_digest ON files (digest);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            self.conn = sqlite3.connect(path, timeout=30)
+            self.conn.text_factory = str  # paths are kept as they're given
+            self.conn.executescript(self._SCHEMA)
+        except sqlite3.DatabaseError, err:
+            error("Couldn't open catalog {0}: {1}".format(path, err))
+
+    @staticmethod
+    def entry(path, fstat, alg):
+        """Returns the row for the file in path with its stat result
+        None if it couldn't be hashed, as damaged files are skipped
+        """
+        try:
+            tagfile = TaggedFile(path)
+            digest = tagfile.hash(alg)
+            if digest is None:
+                return None
+
+            startbyte, endbyte = tagfile.musiclimits  # already parsed by hash
+        except (IOError, OSError, struct.error), err:
+            logging.warning("Couldn't hash {0}: {1}".format(path, err))
+            return None
+
+        return (path,) + file_stamp(fstat) + (startbyte, endbyte, alg, digest)
+
+    def store(self, entries):
+        "Adds or replaces the rows for entries and commits them"
+        self.conn.executemany("INSERT OR REPLACE INTO files "
+                              "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", entries)
+        self.conn.commit()
+
+    def stamp(self, path):
+        "Returns (inode, size, mtime, algorithm, digest) for path, if known"
+        return self.conn.execute("SELECT inode, size, mtime, algorithm, digest "
+                                 "FROM files WHERE path = ?", (path,)).fetchone()
+
+    def digest(self, path, alg='sha1'):
+        """Returns the audio digest for the file in path, taken from the
+        catalog if it didn't change, or hashed and stored otherwise.
+        Returns None on failure
+        """
+        path = catalog_path(path)
+        fstat = os.stat(path)
+        row = self.stamp(path)
+        if row and row[:4] == file_stamp(fstat) + (alg,):
+            return row[4]
+
+        entry = self.entry(path, fstat, alg)
+        if entry:
+            self.store([entry])
+            return entry[-1]
+
+    def scan(self, roots, alg='sha1', extensions=_EXTENSIONS_):
+        """Brings the catalog up to date with the files under roots: hashes
+        the new or changed files with extensions and forgets the ones which
+        are gone. Files are stored in batches, so an interrupted scan keeps
+        most of its work. Links are stored by their real path.
+        Returns (scanned, hashed, removed) counts
+        """
+        roots = [catalog_path(root) for root in roots]
+        known = {}
+        for root in roots:
+            # Every path under root, using the primary key index
+            prefix = os.path.join(root, '')
+            known.update((row[0], row[1:]) for row in self.conn.execute(
+                "SELECT path, inode, size, mtime, algorithm FROM files "
+                "WHERE path >= ? AND path < ?",
+                (prefix, prefix[:-1] + chr(ord(os.sep) + 1))))
+
+        scanned, hashed, entries = 0, 0, []
+        for root in roots:
+            for dirpath, dirnames, filenames in os.walk(root):
+                for name in filenames:
+                    if not name.lower().endswith(extensions):
+                        continue
+
+                    path = os.path.join(dirpath, name)
+                    if os.path.islink(path):
+                        path = catalog_path(path)
+                    try:
+                        fstat = os.stat(path)
+                    except OSError, err:
+                        logging.warning("Couldn't stat {0}: {1}"
+                                        .format(path, err))
+                        continue
+
+                    scanned += 1
+                    stamp = known.pop(path, None)
+                    if stamp is None:  # new, or linked from out of roots
+                        stamp = self.stamp(path)
+                        stamp = stamp and stamp[:4]
+                    if stamp == file_stamp(fstat) + (alg,):
+                        continue
+
+                    entry = self.entry(path, fstat, alg)
+                    if entry:
+                        entries.append(entry)
+                        hashed += 1
+                    if len(entries) >= _BATCH_SIZE_:
+                        self.store(entries)
+                        entries = []
+
+        self.store(entries)
+        self.conn.executemany("DELETE FROM files WHERE path = ?",
+                              ((path,) for path in known))
+        self.conn.commit()
+        return scanned, hashed, len(known)
+
+    def close(self):
+        "Closes internal connection"
+        self.conn.close()
+
+
 def list_algorithms():
     for alg in hashlib.algorithms:
         print alg
@@ -264,6 +422,20 @@ def main():
         error("Unkown '{0}' algorithm. Available options are: {1}"\
               .format(opts.algorithm, ", ".join(hashlib.algorithms)))
 
+    catalog = Catalog(opts.catalog) if opts.catalog else None
+
+    if opts.scan:
+        roots = [os.path.realpath(arg) for arg in args]
+        for root in roots:
+            if not os.path.isdir(root):
+                error("Couldn't scan {0}. It isn't a directory".format(root))
+
+        scanned, hashed, removed = catalog.scan(roots, opts.algorithm)
+        print "Scanned {0} files: {1} hashed, {2} removed".format(
+            scanned, hashed, removed)
+        catalog.close()
+        return
+
     for arg in args:
         path = os.path.realpath(arg)
         if not os.path.isfile(path):
@@ -271,10 +443,15 @@ def main():
                           " regular file".format(arg))
             continue
 
-        tagfile = TaggedFile(path)
-        print tagfile.hash(opts.algorithm),  # No \n
+        if catalog:
+            print catalog.digest(path, opts.algorithm),  # No \n
+        else:
+            print TaggedFile(path).hash(opts.algorithm),  # No \n
         print os.path.basename(path) if not opts.hash else ''
 
+    if catalog:
+        catalog.close()
+
 
 if __name__ == "__main__":
     parser = OptionParser()
@@ -297,10 +474,20 @@ if __name__ == "__main__":
     parser.add_option("-o", "--output", dest="output", action="store",
                       default=False, help="Redirect output to a file")
 
+    parser.add_option("-c", "--catalog", dest="catalog", action="store",
+                      default=None, help="Library catalog database. Hashes "
+                      "are taken from it for unchanged files, and stored "
+                      "in it otherwise")
+
+    parser.add_option("-s", "--scan", dest="scan", action="store_true",
+                      default=False, help="Update the --catalog with every "
+                      "music file in the given directories")
+
     parser.add_option("-v", "--verbose", dest="verbose", action="count",
                       default=0, help="")
 
-    parser.set_usage("Usage: [options] FILE [FILE ..]")
+    parser.set_usage("Usage: [options] FILE [FILE ..]\n"
+                     "       --scan --catalog DB [options] DIR [DIR ..]")
 
     (opts, args) = parser.parse_args()
 
@@ -322,6 +509,11 @@ if __name__ == "__main__":
         print
         error("Insufficient arguments")
 
+    if opts.scan and not opts.catalog:
+        parser.print_help()
+        print
+        error("--scan needs a --catalog to update")
+
     if opts.maxbytes is not None and opts.maxbytes <= 0:
         parser.print_help()
         print
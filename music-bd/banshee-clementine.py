@@ -6,15 +6,28 @@ Syncs playcounts and ratings between banshee and clementine databases.
 Javier Santacruz 12/12/2011
 """
 
+import io
+import os
+import re
 import sys
+import gzip
+import json
+import time
+import fcntl
 import shutil
 import logging
 import sqlite3
-import tempfile
-from abc import ABCMeta
+import unicodedata
+from urlparse import unquote
 from optparse import OptionParser
 
 _LOGGING_FMT_ = '%(asctime)s %(levelname)-8s %(message)s'
+_FICLONE_ = 0x40049409  # linux ioctl cloning a file, see ioctl_ficlone(2)
+_BATCH_SIZE_ = 1024  # rows fetched from sqlite at once
+_BACKUPS_ = 3  # backups kept for each database, see Dbfile.backup_db
+_STATS_FORMAT_ = 'music-bd-stats'  # header of exported files, see export_data
+_STATS_VERSION_ = 1
+_STATS_COLUMNS_ = ['artist', 'album', 'title', 'rating', 'play', 'skip']
 
 
 def error(msg, is_exit=True):
@@ -23,6 +36,83 @@ def error(msg, is_exit=True):
         sys.exit()
 
 
+_FEAT_RE_ = re.compile(r'\s*[\(\[]?\b(?:feat|ft|featuring)\b\.?\s.*$',
+                       re.UNICODE)
+_PUNCT_RE_ = re.compile(r'[\W_]+', re.UNICODE)
+_ASCII_RE_ = re.compile(r'^[\x00-\x7f]*$')
+
+
+def normalize(text):
+    """Returns text reduced for matching: lowercase, without accents, featured
+    artists nor punctuation, and with whitespace collapsed
+    >>> normalize(u'Beyonc\xe9 feat. Jay-Z')
+    u'beyonce'
+    >>> normalize('  Hotel   California (Live) ')
+    u'hotel california live'
+    """
+    if text is None:
+        return u''
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'replace')
+
+    text = text.lower()
+    if not _ASCII_RE_.match(text):
+        text = unicodedata.normalize('NFKD', text)
+        text = u''.join(c for c in text if not unicodedata.combining(c))
+    if u'ft' in text or u'feat' in text:
+        text = _FEAT_RE_.sub(u'', text)
+    return u' '.join(_PUNCT_RE_.sub(u' ', text).split())
+
+
+_NORMALIZED_ = {}  # artists and albums repeat a lot, cache them
+
+
+def fetch_rows(cursor, size=_BATCH_SIZE_):
+    "Yields the rows of cursor, fetched in batches of size"
+    rows = cursor.fetchmany(size)
+    while rows:
+        for row in rows:
+            yield row
+        rows = cursor.fetchmany(size)
+
+
+def uri_path(uri):
+    "Returns the path for a file:// uri. Other locations are left untouched"
+    if uri and uri.startswith('file://'):
+        return unquote(uri[7:].encode('utf-8')).decode('utf-8', 'replace')
+    return uri
+
+
+_REAL_DIRS_ = {}  # directory -> its real path, see catalog_path
+
+
+# Copied as is in mp3hash.py, list.py and banshee-clementine.py, as each
+# script runs on its own: keep the three copies in step
+def catalog_path(path):
+    """Returns the key of path in the library catalog: its real path, in
+    utf-8, so every tool finds the same file under the same key.
+    Directories are resolved once, as a library has lots of files in each"""
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    directory, name = os.path.split(os.path.abspath(path))
+    if directory not in _REAL_DIRS_:
+        _REAL_DIRS_[directory] = os.path.realpath(directory)
+    path = os.path.join(_REAL_DIRS_[directory], name)
+    if os.path.islink(path):
+        path = os.path.realpath(path)
+    return path
+
+
+def match_key(artist, album, title):
+    "Returns the key matching tracks between databases"
+    for text in (artist, album):
+        if text not in _NORMALIZED_:
+            _NORMALIZED_[text] = normalize(text)
+
+    return u'\x1f'.join((_NORMALIZED_[artist], _NORMALIZED_[album],
+                         normalize(title)))
+
+
 class Dbfile(object):
     """Dbfile Banshee/Clementine operations"""
 
@@ -35,50 +125,28 @@ class Dbfile(object):
             FROM CoreTracks
             INNER JOIN CoreArtists ON CoreTracks.ArtistID = CoreArtists.ArtistID
             INNER JOIN CoreAlbums ON CoreTracks.AlbumID = CoreAlbums.AlbumID
+            WHERE {0}
+            """,
+
+            # Conditions for extract
+            'rated': "CoreTracks.Rating > 0",
+            'played': "CoreTracks.PlayCount > 0 OR CoreTracks.SkipCount > 0",
 
-            WHERE CoreTracks.Rating > 0
-            OR CoreTracks.PlayCount > 0
-            OR CoreTracks.SkipCount > 0
-            ORDER BY CoreArtists.Name,CoreAlbums.Title,CoreTracks.Title;
+            # Every track with the columns matched against the source rows
+            'keys': """
+            SELECT CoreTracks.TrackID AS id, CoreArtists.Name AS artist,
+            CoreAlbums.Title AS album, CoreTracks.Title AS title
+            FROM CoreTracks
+            INNER JOIN CoreArtists ON CoreTracks.ArtistID = CoreArtists.ArtistID
+            INNER JOIN CoreAlbums ON CoreTracks.AlbumID = CoreAlbums.AlbumID
             """,
 
-            'update': {
-                'overwrite': """
-                              UPDATE CoreTracks
-                              SET Rating = :rating,
-                                  PlayCount = :play,
-                                  SkipCount = :skip
-                              WHERE CoreTracks.TrackID = (
-                                SELECT CoreTracks.TrackID
-                                FROM CoreTracks
-                                INNER JOIN CoreArtists
-                                  ON CoreTracks.ArtistID = CoreArtists.ArtistID
-                                INNER JOIN CoreAlbums
-                                  ON CoreTracks.AlbumID = CoreAlbums.AlbumID
-                                WHERE  CoreTracks.Title = :title
-                                  AND CoreArtists.Name = :artist
-                                  AND CoreAlbums.Title = :album
-                                LIMIT 1);
-                              """,
-
-                'noverwrite': """
-                                UPDATE CoreTracks
-                                SET Rating = :rating,
-                                    PlayCount = PlayCount + :play,
-                                    SkipCount = SkipCount + :skip
-                                WHERE CoreTracks.TrackID = (
-                                  SELECT CoreTracks.TrackID
-                                  FROM CoreTracks
-                                  INNER JOIN CoreArtists
-                                  ON CoreTracks.ArtistID = CoreArtists.ArtistID
-                                  INNER JOIN CoreAlbums
-                                  ON CoreTracks.AlbumID = CoreAlbums.AlbumID
-                                  WHERE  CoreTracks.Title = :title
-                                    AND CoreArtists.Name = :artist
-                                    AND CoreAlbums.Title = :album
-                                  LIMIT 1);
-                                """
-            }
+            # Every track by its file uri, with the rating as {0}
+            'files': """
+            SELECT Uri AS uri, {0} AS rating, PlayCount AS play,
+            SkipCount AS skip
+            FROM CoreTracks
+            """
     },
 
         'clementine': {
@@ -86,79 +154,128 @@ class Dbfile(object):
             'extract': """
             SELECT artist,album,title,rating,playcount,skipcount
             FROM songs
-            WHERE rating > -1
-            OR playcount > 0
-            OR skipcount > 0
-            ORDER BY artist,album,title;
+            WHERE {0}
             """,
 
-            'update': {
-                'overwrite': """
-                              UPDATE songs
-                              SET rating = :rating,
-                              playcount = :play,
-                              skipcount = :skip
-                              WHERE artist = :artist
-                              AND album = :album
-                              AND title = :title;
-                              """
-                             ,
-
-                'noverwrite':  """
-                               UPDATE songs
-                               SET rating = :rating,
-                               playcount = playcount + :play,
-                               skipcount = skipcount + :skip
-                               WHERE artist = :artist
-                               AND album = :album
-                               AND title = :title;
-                               """
-            }
+            # Conditions for extract
+            'rated': "rating > -1",
+            'played': "playcount > 0 OR skipcount > 0",
+
+            # Every track with the columns matched against the source rows
+            'keys': """
+            SELECT ROWID AS id, artist, album, title
+            FROM songs
+            """,
+
+            # Every track by its file uri, with the rating as {0}
+            'files': """
+            SELECT filename AS uri, {0} AS rating, playcount AS play,
+            skipcount AS skip
+            FROM songs
+            """
         }
     }
 
+    # Updated table for each format: (table, id, rating, playcount, skipcount)
+    _COLUMNS = {'banshee': ('CoreTracks', 'TrackID', 'Rating', 'PlayCount',
+                            'SkipCount'),
+                'clementine': ('songs', 'ROWID', 'rating', 'playcount',
+                               'skipcount')}
+
+    # Expressions converting a rating from each format to the clementine
+    # scale, [0-1] with NULL for unrated tracks, and back from it
+    _RATINGS = {'banshee': ("NULLIF({0}, 0) / 5.0",
+                            "CAST(ROUND({0} * 5) AS INTEGER)"),
+                'clementine': ("NULLIF({0}, -1)", "{0}")}
+
     # Known tables for each format
     _TABLES = { 'banshee': ['CoreTracks', 'CoreAlbums', 'CoreArtists'],
                'clementine': ['songs', 'playlists', 'playlist_items']
               }
 
-    def __init__(self, dbpath):
-        self.dbpath = dbpath
-        self.bkpath = self.backup_db()
+    def __init__(self, dbpath, backup=True):
+        """Opens the database in dbpath, backing it up first if backup is set.
+        Changes are done in place, see begin, commit and rollback.
+        """
+        if not os.path.isfile(dbpath):
+            error("Couldn't find database {0}".format(dbpath))
 
-        self.conn = self.open_db(self.bkpath)
+        self.dbpath = dbpath
+        self.conn = self.open_db(self.dbpath)
+        self.conn.isolation_level = None  # transactions are explicit
+        self.conn.create_function('match_key', 3, match_key)
+        self.bkpath = self.backup_db() if backup else None
         self.format = self.detect_format()
+        self.indexed = False
 
     @staticmethod
     def open_db(dbpath):
-        "Opens and returns a sqlite connection"
+        """Opens and returns a sqlite connection
+        Waits for a while if the database is locked by a running player
+        """
         try:
-            return sqlite3.connect(dbpath)
+            return sqlite3.connect(dbpath, timeout=30)
         except sqlite3.DatabaseError, err:
             error("Couldn't connect to database in {0}: {1}"
                   .format(dbpath, err))
 
-    def row(self, rawrow):
-        "Returns a RowOperations object from a given sqlite row"
-        # Get operations object
-        if self.format is 'banshee':
-            return BansheeRow(rawrow)
-        elif self.format is 'clementine':
-            return ClementineRow(rawrow)
-        else:
-            error("Unkown format for dbfile: {0}".format(self.dbpath))
-
     def backup_db(self):
-        """Backs the destination database into a temporary file.
-        Returns the path for the copy or None in case of failure
+        """Backs the database up next to it, as dbpath.bk, keeping the
+        _BACKUPS_ last ones: the previous are moved to dbpath.bk.1, .bk.2...
+        The file is cloned when the filesystem supports it (btrfs, xfs...),
+        while holding a read lock so it's consistent. Otherwise, or for
+        databases in WAL mode, the copy is done by sqlite with VACUUM INTO,
+        which is safe while a player is using the database.
+        Returns the path for the copy
         """
-        with tempfile.NamedTemporaryFile(delete=False) as bkfile:
-            with open(self.dbpath, 'r') as origfile:
-                shutil.copyfileobj(origfile, bkfile)
-                logging.info("Backed up {0} to {1}".format(self.dbpath, bkfile.name))
-                return bkfile.name
-
-        error("Couldn't backup {0}".format(self.dbpath))
+        bkpath = "{0}.bk".format(self.dbpath)
+        tmppath = "{0}.tmp".format(bkpath)
+        try:
+            if os.path.exists(tmppath):  # left by an interrupted backup
+                os.remove(tmppath)
+
+            mode = self.conn.execute("PRAGMA journal_mode").fetchone()[0]
+            if mode.lower() != 'wal' and self.locked_copy(tmppath, reflink):
+                action = "Cloned"
+            elif sqlite3.sqlite_version_info >= (3, 27, 0):
+                self.conn.execute("VACUUM INTO ?", (tmppath,))
+                action = "Backed up"
+            else:
+                self.conn.execute("PRAGMA wal_checkpoint")
+                self.locked_copy(tmppath, shutil.copyfile)
+                action = "Backed up"
+
+            # Older backups move one place back, and the oldest goes away
+            names = [bkpath] + ["{0}.{1}".format(bkpath, n)
+                                for n in xrange(1, _BACKUPS_)]
+            for older, newer in reversed(zip(names[1:], names)):
+                if os.path.exists(newer):
+                    os.rename(newer, older)
+            os.rename(tmppath, bkpath)
+        except (sqlite3.DatabaseError, IOError, OSError), err:
+            error("Couldn't backup {0}: {1}".format(self.dbpath, err))
+
+        logging.info("{0} {1} to {2}".format(action, self.dbpath, bkpath))
+        return bkpath
+
+    def locked_copy(self, bkpath, copier):
+        """Copies the database file to bkpath with copier(src, dest) while
+        holding a read lock, so no one can write it meanwhile.
+        Returns True on success, False if copier raised IOError
+        """
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+            copier(self.dbpath, bkpath)
+        except IOError, err:
+            logging.debug("Couldn't copy {0}: {1}".format(self.dbpath, err))
+            if os.path.exists(bkpath):
+                os.remove(bkpath)
+            return False
+        finally:
+            self.conn.execute("COMMIT")
+
+        return True
 
     def detect_format(self):
         """Returns the format for the database which conn is connected:
@@ -173,173 +290,520 @@ class Dbfile(object):
                 for table in tests:
                     cursor.execute("SELECT * FROM {0} LIMIT 1".format(table))
             except sqlite3.DatabaseError:
-                logging.debug("Failed query using table {1}".format(table))
+                logging.debug("Failed query using table {0}".format(table))
                 dbformat = None
             else:
                 # If all tests for a given format passed, that's it
                 return dbformat
 
-    def copy_data(self, from_db, overwrite=False):
-        """Copies and sets values from 'from_db' to database backup
-        Default behaviour is to add playcounts and skipcounts
-        use overwrite to avoid this.
+    def rating_sql(self, column, from_format):
+        """Returns the expression converting the rating in column from
+        from_format to this db format. Unrated tracks are NULL.
+        """
+        scale = self._RATINGS[from_format][0].format(column)
+        return self._RATINGS[self.format][1].format(scale)
+
+    def update_query(self, overwrite=False):
+        """Returns the statement updating all the tracks in sync_matches.
+        UPDATE ... FROM is used when available (sqlite 3.33), otherwise each
+        column is looked up in sync_matches by its primary key.
+        Tracks with a NULL rating in sync_matches keep their rating.
         """
-        # Get cursors for backup files
-        tocur, fromcur = self.conn.cursor(), self.conn.cursor()
-        overw = 'overwrite' if overwrite else 'noverwrite'
+        table, tid, rating, play, skip = self._COLUMNS[self.format]
+        values = {'rating': 'sync_matches.rating',
+                  'play': 'sync_matches.play',
+                  'skip': 'sync_matches.skip'}
+
+        if sqlite3.sqlite_version_info < (3, 33, 0):
+            lookup = "(SELECT {{0}} FROM sync_matches "\
+                     "WHERE sync_matches.id = {0}.{1})".format(table, tid)
+            values = dict((k, lookup.format(k)) for k in values)
+
+        sets = ["{0} = COALESCE({1}, {2}.{0})".format(rating, values['rating'],
+                                                      table)]
+        for column, key in ((play, 'play'), (skip, 'skip')):
+            sets.append("{0} = {1}{2}".format(
+                column, '' if overwrite else "{0}.{1} + ".format(table, column),
+                values[key]))
+
+        if sqlite3.sqlite_version_info < (3, 33, 0):
+            return "UPDATE {0} SET {1} WHERE {0}.{2} IN "\
+                   "(SELECT id FROM sync_matches)"\
+                   .format(table, ", ".join(sets), tid)
+
+        return "UPDATE {0} SET {1} FROM sync_matches "\
+               "WHERE {0}.{2} = sync_matches.id"\
+               .format(table, ", ".join(sets), tid)
+
+    def build_index(self):
+        """Builds the temporary sync_keys table, indexing every track id by
+        its match_key, so rows are matched despite differences in case,
+        accents, punctuation or featured artists. Built once per run.
+        """
+        if self.indexed:
+            return
+
+        logging.info("Indexing tracks in {0}".format(self.dbpath))
+        cursor = self.conn.cursor()
+        cursor.execute("CREATE TEMP TABLE sync_keys (id INTEGER, key TEXT)")
+        cursor.execute("""
+            INSERT INTO sync_keys
+            SELECT keys.id, match_key(keys.artist, keys.album, keys.title)
+            FROM ({0}) AS keys""".format(self._QUERIES[self.format]['keys']))
+        cursor.execute("CREATE INDEX temp.sync_keys_key ON sync_keys (key)")
+        self.indexed = True
+
+    def report_matches(self):
+        "Logs the rows in sync_rows matching no track or more than one"
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            SELECT artist, album, title FROM sync_rows
+            WHERE NOT EXISTS (SELECT 1 FROM sync_keys
+                              WHERE sync_keys.key = sync_rows.key)""")
+        unmatched = 0
+        for row in cursor:
+            unmatched += 1
+            logging.info(u"Unmatched track: {0} - {1} - {2}".format(*row))
+
+        cursor.execute("""
+            SELECT artist, album, title, COUNT(*) FROM sync_rows
+            INNER JOIN sync_keys ON sync_keys.key = sync_rows.key
+            GROUP BY sync_rows.ROWID HAVING COUNT(*) > 1""")
+        ambiguous = 0
+        for row in cursor:
+            ambiguous += 1
+            logging.info(u"Ambiguous track, matches {3}: {0} - {1} - {2}"
+                         .format(*row))
+
+        if unmatched or ambiguous:
+            logging.warning("{0} unmatched and {1} ambiguous tracks in {2}"
+                            .format(unmatched, ambiguous, self.dbpath))
+
+    def bulk_update(self, rows, from_format, overwrite=False):
+        """Applies all rows (artist, album, title, rating, play, skip) at once
+        Rows are loaded into a temporary table, matched against the tracks
+        by their match_key in a single join and applied with a single update
+        statement. Rows matching several tracks update all of them.
+        Source rows matching the same track are merged, keeping the highest
+        rating and adding their counts. Ratings are converted from
+        from_format, and unrated or None ratings are left untouched.
+        Returns the number of tracks updated
+        """
+        self.build_index()
+
+        cursor = self.conn.cursor()
+        cursor.execute("""
+            CREATE TEMP TABLE sync_rows (artist TEXT, album TEXT, title TEXT,
+                                         rating REAL, play INTEGER,
+                                         skip INTEGER, key TEXT)""")
+        cursor.executemany("INSERT INTO sync_rows (artist, album, title, "
+                           "rating, play, skip) VALUES (?, ?, ?, ?, ?, ?)",
+                           rows)
+        cursor.execute("UPDATE sync_rows SET key = match_key(artist, album, "
+                       "title)")
+        cursor.execute("CREATE INDEX temp.sync_rows_key ON sync_rows (key)")
+        self.report_matches()
+
+        cursor.execute("""
+            CREATE TEMP TABLE sync_matches (id INTEGER PRIMARY KEY,
+                                            rating REAL, play INTEGER,
+                                            skip INTEGER)""")
+        cursor.execute("""
+            INSERT INTO sync_matches
+            SELECT sync_keys.id, MAX({0}), SUM(sync_rows.play),
+                   SUM(sync_rows.skip)
+            FROM sync_rows
+            INNER JOIN sync_keys ON sync_keys.key = sync_rows.key
+            GROUP BY sync_keys.id"""
+                       .format(self.rating_sql('sync_rows.rating', from_format)))
+
+        cursor.execute(self.update_query(overwrite))
+        updated = cursor.rowcount
+
+        cursor.execute("DROP TABLE temp.sync_matches")
+        cursor.execute("DROP TABLE temp.sync_rows")
+        return updated
+
+    def extract(self, only_rated=False):
+        """Returns a cursor over the rated or played tracks in the database
+        as (artist, album, title, rating, play, skip) rows
+        Use only_rated to leave out unrated tracks.
+        """
+        queries = self._QUERIES[self.format]
+        where = queries['rated']
+        if not only_rated:
+            where += " OR " + queries['played']
 
-        # Query all tracks from 'from_db'
-        logging.info("Retrieving data from {0}".format(from_db.dbpath))
         try:
-            fromcur.execute(self._QUERIES[from_db.format]['extract'])
+            return self.conn.execute(queries['extract'].format(where))
         except sqlite3.DatabaseError, err:
             error("Error detected while extracting from {0}: {1}"\
-                .format(from_db.dbpath, str(err)))
+                .format(self.dbpath, str(err)))
+
+    def copy_data(self, from_db, overwrite=False, only_rated=False):
+        """Copies and sets values from 'from_db' to database backup
+        Default behaviour is to add playcounts and skipcounts
+        use overwrite to avoid this, and only_rated to skip unrated tracks.
+        All changes are applied in a single transaction, see bulk_update.
+        """
+        # Query all tracks from 'from_db'
+        logging.info("Retrieving data from {0}".format(from_db.dbpath))
+        fromcur = from_db.extract(only_rated)
 
         # Update database
         logging.info("Updating {0}'s ratings and counters".format(self.dbpath))
-        counter = 0
-        for row in fromcur:
-            row = from_db.row(row)
+        try:
+            self.begin()
+            counter = self.bulk_update(fetch_rows(fromcur), from_db.format,
+                                       overwrite)
+        except sqlite3.DatabaseError, err:
+            self.rollback()
+            error("Error detected while updating db: {0}".format(err))
 
-            # Check whether the row should be updated
-            if not row.check():
-                logging.debug("Ignoring row: {0}".format(row.row))
-                continue
+        logging.info("{0} tracks successfully updated".format(counter))
 
-            # Transform numeric schemes from from_db to this db format
-            row.transform(self.format)
+    def export_data(self, path, only_rated=False):
+        """Writes the rated or played tracks to path, gzipped: a json header
+        with the format, version, columns and rating scale, and a json array
+        for every track in the following lines. Use only_rated to leave out
+        unrated tracks.
+        Returns the number of tracks exported
+        """
+        header = {'format': _STATS_FORMAT_, 'version': _STATS_VERSION_,
+                  'columns': _STATS_COLUMNS_, 'rating': self.format,
+                  'source': os.path.basename(self.dbpath),
+                  'created': time.time()}
+
+        logging.info("Exporting {0} to {1}".format(self.dbpath, path))
+        cursor = self.extract(only_rated)
+        count = 0
+        try:
+            with gzip.open(path, 'wb') as stats:
+                stats.write(json.dumps(header) + '\n')
+                rows = cursor.fetchmany(_BATCH_SIZE_)
+                while rows:
+                    count += len(rows)
+                    stats.write(''.join(json.dumps(row, separators=(',', ':'))
+                                        + '\n' for row in rows))
+                    rows = cursor.fetchmany(_BATCH_SIZE_)
+        except IOError, err:
+            error("Couldn't export to {0}: {1}".format(path, err))
+
+        logging.info("{0} tracks exported".format(count))
+        return count
+
+    def import_data(self, path, overwrite=False):
+        """Sets the values exported to path by export_data, from any format.
+        Default behaviour is to add playcounts and skipcounts
+        use overwrite to avoid this.
+        All changes are applied in a single transaction, see bulk_update.
+        """
+        try:
+            stats = io.BufferedReader(gzip.open(path, 'rb'))
+            header = json.loads(stats.readline())
+        except (IOError, ValueError), err:
+            error("Couldn't read exported stats in {0}: {1}".format(path, err))
+
+        if header.get('format') != _STATS_FORMAT_ or \
+           header.get('version') > _STATS_VERSION_ or \
+           sorted(header.get('columns', [])) != sorted(_STATS_COLUMNS_) or \
+           header.get('rating') not in self._RATINGS:
+            error("Unknown format for exported stats in {0}".format(path))
+
+        rows = (json.loads(line) for line in stats)
+        if header['columns'] != _STATS_COLUMNS_:
+            order = [header['columns'].index(col) for col in _STATS_COLUMNS_]
+            rows = ([row[i] for i in order] for row in rows)
+
+        logging.info("Updating {0}'s ratings and counters from {1}"
+                     .format(self.dbpath, path))
+        try:
+            self.begin()
+            counter = self.bulk_update(rows, header['rating'], overwrite)
+        except (sqlite3.DatabaseError, IOError, ValueError), err:
+            self.rollback()
+            error("Error detected while updating db: {0}".format(err))
+        finally:
+            stats.close()
 
-            logging.debug("Changing row: {0}".format(row.row))
+        logging.info("{0} tracks successfully updated".format(counter))
 
-            try:
-                tocur.execute(self._QUERIES[self.format]['update'][overw],
-                              { "artist":  row['artist'],
-                                "album":   row['album'],
-                                "title":   row['title'],
-                                "rating":  float(row['rating']),
-                                "play":    int(row['play']),
-                                "skip":    int(row['skip']) })
-
-            except sqlite3.DatabaseError, err:
-                error("Error detected while updating db: {0}".format(err))
-            counter += 1
+    def catalog_data(self, path):
+        """Stores the rating, playcount and skipcount of every track in the
+        library catalog in path, shared with mp3hash and lists, by database
+        and real file path (see catalog_path). Ratings are in clementine
+        scale, NULL when unrated. Only tracks in local files are stored.
+        The previous stats of this database are replaced.
+        Returns the number of tracks stored
+        """
+        columns = self._COLUMNS[self.format]
+        rating = self._RATINGS[self.format][0].format(columns[2])
+        files = self._QUERIES[self.format]['files'].format(rating)
+        dbid = os.path.realpath(self.dbpath)
+
+        # The player database is only read, the catalog has its own
+        # connection so only the catalog is locked while writing
+        logging.info("Storing {0}'s stats in {1}".format(self.dbpath, path))
+        catalog = self.open_db(path)
+        catalog.isolation_level = None  # transactions are explicit
+        catalog.text_factory = str  # paths are utf-8, as in mp3hash
+        try:
+            catalog.execute("BEGIN IMMEDIATE")
+            catalog.execute("""
+                CREATE TABLE IF NOT EXISTS stats (
+                    path TEXT, db TEXT, player TEXT, rating REAL,
+                    playcount INTEGER, skipcount INTEGER, updated REAL,
+                    PRIMARY KEY (path, db))""")
+            catalog.execute("DELETE FROM stats WHERE db = ?", (dbid,))
+            rows = self.conn.execute("""
+                SELECT uri, rating, play, skip FROM ({0}) AS files
+                WHERE uri LIKE 'file://%' OR uri LIKE '/%'""".format(files))
+            updated = time.time()
+            count = catalog.executemany(
+                "INSERT OR REPLACE INTO stats VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((catalog_path(uri_path(uri)), dbid, self.format, rating,
+                  play, skip, updated)
+                 for uri, rating, play, skip in fetch_rows(rows))).rowcount
+            catalog.execute("COMMIT")
+        except sqlite3.DatabaseError, err:
+            catalog.execute("ROLLBACK")
+            error("Couldn't store stats in catalog {0}: {1}".format(path, err))
+        finally:
+            catalog.close()
 
-        logging.info("{0} tracks successfully updated".format(counter))
+        logging.info("{0} tracks stored".format(count))
+        return count
 
     def close(self):
         "Closes internal connection"
         self.conn.close()
 
+    def begin(self):
+        "Starts the transaction holding all the changes to the database"
+        self.conn.execute("SAVEPOINT sync")
+
+    def rollback(self):
+        "Discards all the changes since begin"
+        self.conn.execute("ROLLBACK TO SAVEPOINT sync")
+        self.conn.execute("RELEASE SAVEPOINT sync")
+
     def commit(self):
-        "Commit changes and overwrite original db"
-        # commit changes
-        self.conn.commit()
+        "Commits all the changes since begin to the database"
         try:
-            shutil.move(self.bkpath, self.dbpath)
-        except shutil.Error:
-            error("Couldn't overwrite {1} with {0}"
-                  .format(self.dbpath, self.bkpath))
+            self.conn.execute("RELEASE SAVEPOINT sync")
+        except sqlite3.DatabaseError, err:
+            self.rollback()
+            error("Couldn't commit changes to {0}: {1}"
+                  .format(self.dbpath, err))
         else:
             logging.info("Updated {0}".format(self.dbpath))
 
 
-class RowOperations(object):
-    "Common row operatons. Abstract class, do not instantiate"
-
-    __metaclass__ = ABCMeta
-
-    _fields = ['artist', 'album', 'title', 'rating', 'play', 'skip']
-
-    def __init__(self, row):
-        self.row = list(row)
-
-    def check(self):
-        "Returns True if it should be updated"
-        if opts.only_rated:
-            return self.is_rated()
-
-        return self.is_rated() or self.is_played() or self.is_skipped()
-
-    def is_played(self):
-        "Returns if the row has playcounts"
-        # row fields: [artist album title rating playcount skipcount]
-        return self.row[4] > 0
-
-    def is_skipped(self):
-        "Returns if the row has skipcounts"
-        # row fields: [artist album title rating playcount skipcount]
-        return self.row[5] > 0
-
-    def _find(self, name):
-        for i, field in enumerate(self._fields):
-            if field == name:
-                return i
-
-    def __getitem__(self, key):
-        if isinstance(key, str):
-            key = self._find(key)
-            if key is None:
-                raise IndexError("{0} is not a field of row".format(key))
-
-        return self.row[key]
-
-    def __setitem__(self, key, val):
-        if isinstance(key, str):
-            key = self._find(key)
-            if key is None:
-                raise IndexError("{0} is not a field of row".format(key))
-
-        self.row[key] = val
-
+class SyncState(object):
+    """Remembers the counters of every track in each database after the last
+    sync, so following syncs only apply what changed since then.
+    Databases are identified by their real path and tracks by their
+    match_key. Ratings are kept in the scale of their database.
+    """
 
-class BansheeRow(RowOperations):
-    "Banshee row operations"
-
-    def is_rated(self):
-        "Returns if the row has been rated"
-        # row fields: [artist album title rating playcount skipcount]
-        return self.row[3] == 0
+    def __init__(self, path):
+        self.path = path
+        try:
+            self.conn = sqlite3.connect(path, timeout=30)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS counters (
+                    db TEXT, key TEXT, rating REAL, play INTEGER,
+                    skip INTEGER, PRIMARY KEY (db, key))""")
+            self.conn.commit()
+        except sqlite3.DatabaseError, err:
+            error("Couldn't open sync state {0}: {1}".format(path, err))
 
-    def transform(self, to_format):
-        """Transforms and returns the row to to_format
-        Move ratings from [-1-5] to [0-1] for clementine
+    def load(self, dbfile):
+        """Loads the current rows of dbfile into the temporary table current
+        Rows for the same track are merged as in Dbfile.bulk_update
+        """
+        cursor = self.conn.cursor()
+        cursor.execute("DROP TABLE IF EXISTS temp.current_rows")
+        cursor.execute("DROP TABLE IF EXISTS temp.current")
+        cursor.execute("""
+            CREATE TEMP TABLE current_rows (key TEXT, artist TEXT,
+                                            album TEXT, title TEXT,
+                                            rating REAL, play INTEGER,
+                                            skip INTEGER)""")
+        cursor.executemany(
+            "INSERT INTO current_rows VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ((match_key(*row[:3]),) + row
+             for row in fetch_rows(dbfile.extract())))
+        cursor.execute("""
+            CREATE TEMP TABLE current AS
+            SELECT key, artist, album, title, MAX(rating) AS rating,
+                   SUM(play) AS play, SUM(skip) AS skip
+            FROM current_rows GROUP BY key""")
+        cursor.execute("CREATE UNIQUE INDEX temp.current_key ON current (key)")
+        cursor.execute("DROP TABLE temp.current_rows")
+
+    def changes(self, dbfile):
+        """Returns the rows which changed in dbfile since the last sync as
+        (artist, album, title, rating, play, skip), with ratings in
+        clementine format. Counts are the increments since the last sync and
+        rating is None if it didn't change or was unset. On the first sync
+        everything is a change.
         """
-        # row fields: [artist album title rating playcount skipcount]
-        if to_format == 'clementine':
-            if self.row[3] == -1:
-                self.row[3] = 0
-            self.row[3] *= 0.2
+        self.load(dbfile)
+        rating = Dbfile._RATINGS[dbfile.format][0].format('cur.rating')
+        return self.conn.execute("""
+            SELECT cur.artist, cur.album, cur.title,
+                   CASE WHEN last.key IS NULL OR last.rating IS NOT cur.rating
+                        THEN {0} END,
+                   MAX(cur.play - COALESCE(last.play, 0), 0),
+                   MAX(cur.skip - COALESCE(last.skip, 0), 0)
+            FROM current AS cur
+            LEFT JOIN counters AS last ON last.db = ? AND last.key = cur.key
+            WHERE last.key IS NULL OR last.rating IS NOT cur.rating
+               OR cur.play > COALESCE(last.play, 0)
+               OR cur.skip > COALESCE(last.skip, 0)""".format(rating),
+            (os.path.realpath(dbfile.dbpath),)).fetchall()
+
+    def save(self, dbfile):
+        "Records the current counters of dbfile as synced"
+        self.load(dbfile)
+        dbid = os.path.realpath(dbfile.dbpath)
+        self.conn.execute("DELETE FROM counters WHERE db = ?", (dbid,))
+        self.conn.execute("""
+            INSERT INTO counters
+            SELECT ?, key, rating, play, skip FROM current""", (dbid,))
+        self.conn.commit()
 
-        return self.row
+    def close(self):
+        "Closes internal connection"
+        self.conn.close()
 
 
-class ClementineRow(RowOperations):
-    "Clementine row operations"
+def sync_incremental(db_a, db_b, state):
+    """Syncs two databases both ways applying only the changes since the last
+    sync recorded in state: rating changes and count increments.
+    Tracks rated in both since then get the highest of both ratings, in both,
+    as in merge_dbs.
+    """
+    merge_dbs([db_a, db_b], state)
+
+
+def merge_changes(dbs, state):
+    """Returns the changes in dbs since the last sync merged by track, as
+    {key: [artist, album, title, rating, play, skip, own]}: the highest
+    changed rating in clementine scale (None if unchanged), the count
+    increments added up for all dbs and own, with the increments (play, skip)
+    of each db by its index in dbs.
+    Each database is only read once.
+    """
+    merged = {}
+    for index, db in enumerate(dbs):
+        logging.info("Looking for changes in {0}".format(db.dbpath))
+        for row in state.changes(db):
+            track = merged.setdefault(match_key(*row[:3]),
+                                      [row[0], row[1], row[2], None, 0, 0, {}])
+            if row[3] is not None and (track[3] is None or row[3] > track[3]):
+                track[3] = row[3]
+
+            track[4] += row[4]
+            track[5] += row[5]
+            track[6][index] = (row[4], row[5])
+
+    return merged
+
+
+def merged_rows(merged, index):
+    """Yields the rows from merged to be applied to the db at index: the
+    increments from every other db and the merged rating.
+    """
+    for artist, album, title, rating, play, skip, own in merged.itervalues():
+        own_play, own_skip = own.get(index, (0, 0))
+        play, skip = play - own_play, skip - own_skip
+        if rating is None and not play and not skip:
+            continue
+
+        yield (artist, album, title, rating, play, skip)
+
+
+def merge_dbs(dbs, state):
+    """Merges the changes since the last sync of all dbs into all of them.
+    Tracks get the highest rating set in any of them, and the plays and
+    skips added in each of them. Every database is read once and updated in
+    a single batch, instead of syncing every pair of them.
+    """
+    merged = merge_changes(dbs, state)
+    logging.info("{0} tracks changed since the last sync".format(len(merged)))
+
+    for index, db in enumerate(dbs):
+        logging.info("Updating {0}'s ratings and counters".format(db.dbpath))
+        try:
+            db.begin()
+            counter = db.bulk_update(merged_rows(merged, index), 'clementine')
+        except sqlite3.DatabaseError, err:
+            db.rollback()
+            error("Error detected while updating db: {0}".format(err))
+        logging.info("{0} tracks successfully updated".format(counter))
 
-    def is_rated(self):
-        "Returns if the row has been rated"
-        # row fields: [artist album title rating playcount skipcount]
-        return self.row[3] == -1
+    for db in dbs:
+        db.commit()
+    for db in dbs:
+        state.save(db)
 
-    def transform(self, to_format):
-        """Transforms and returns the row to to_format
-        Move ratings from [0-1] to [-1-5] for banshee
-        """
-        # row fields: [artist album title rating playcount skipcount]
-        if to_format == 'banshee':
-            self.row[3] *= 5
-            if self.row[3] == 0:
-                self.row[3] = -1
 
-        return self.row
+def reflink(src, dest):
+    """Clones src into dest, sharing their data until any of them changes.
+    Raises IOError if the filesystem doesn't support it
+    """
+    with open(src, 'rb') as sfile:
+        with open(dest, 'wb') as dfile:
+            fcntl.ioctl(dfile.fileno(), _FICLONE_, sfile.fileno())
 
 
 def main(opts, args):
 
-    from_db, to_db = Dbfile(opts.dbfrom), Dbfile(opts.dbto)
-
-    to_db.copy_data(from_db, opts.overwrite)
+    if opts.catalog:
+        for path in opts.dbs:
+            db = Dbfile(path, backup=False)  # only read
+            db.catalog_data(opts.catalog)
+            db.close()
+        return
+
+    if opts.export:
+        db = Dbfile(opts.dbs[0], backup=False)  # only read
+        db.export_data(opts.export, opts.only_rated)
+        db.close()
+        return
+
+    if opts.import_from:
+        db = Dbfile(opts.dbs[0], backup=not opts.no_backup)
+        db.import_data(opts.import_from, opts.overwrite)
+        db.commit()
+        db.close()
+        return
+
+    if opts.merge:
+        dbs = [Dbfile(path, backup=not opts.no_backup) for path in opts.dbs]
+        state = SyncState(opts.state)
+        merge_dbs(dbs, state)
+        state.close()
+        for db in dbs:
+            db.close()
+        return
+
+    if opts.incremental:
+        db_a = Dbfile(opts.dbfrom, backup=not opts.no_backup)
+        db_b = Dbfile(opts.dbto, backup=not opts.no_backup)
+        state = SyncState(opts.state)
+        sync_incremental(db_a, db_b, state)
+        state.close()
+        db_a.close()
+        db_b.close()
+        return
+
+    from_db = Dbfile(opts.dbfrom, backup=False)  # only read
+    to_db = Dbfile(opts.dbto, backup=not opts.no_backup)
+
+    to_db.copy_data(from_db, opts.overwrite, opts.only_rated)
     to_db.commit()
     to_db.close()
     from_db.close()
@@ -363,15 +827,52 @@ if __name__ == "__main__":
                       action="store", default="",
                       help="Destination database path")
 
+    parser.add_option("-n", "--no-backup", dest="no_backup",
+                      action="store_true", default=False,
+                      help="Don't backup the destination database")
+
+    parser.add_option("-i", "--incremental", dest="incremental",
+                      action="store_true", default=False,
+                      help="Sync both ways only what changed since the last "
+                      "incremental sync")
+
+    parser.add_option("-s", "--state", dest="state", action="store",
+                      default=os.path.expanduser("~/.music-bd-state.db"),
+                      help="Where --incremental remembers the last sync. "
+                      "Default ~/.music-bd-state.db")
+
+    parser.add_option("-m", "--merge", dest="merge",
+                      action="store_true", default=False,
+                      help="Merge what changed since the last sync in all the "
+                      "given databases into all of them")
+
+    parser.add_option("-e", "--export", dest="export", action="store",
+                      default=None, help="Export the stats of the database "
+                      "to a file, to be imported with --import")
+
+    parser.add_option("-I", "--import", dest="import_from", action="store",
+                      default=None, help="Import the stats exported to a file "
+                      "with --export into the database")
+
+    parser.add_option("-C", "--catalog", dest="catalog", action="store",
+                      default=None, help="Store the stats of the databases "
+                      "in a library catalog, by file path")
+
     parser.add_option("-v", "--verbose", dest="verbose",
                       action="count", default=0,
                       help="Verbosity. Default silent. -v (info) -vv (debug)")
 
     parser.set_usage("Exports ratings/playcounts from one clementine/banshee "
-                     "db to another\n\tUsage: [options] [dbfrom, [dbto]]\n")
+                     "db to another\n\tUsage: [options] [dbfrom, [dbto]]\n"
+                     "\t       --merge [options] db db [db...]\n"
+                     "\t       --export file [options] db\n"
+                     "\t       --import file [options] db\n"
+                     "\t       --catalog file [options] db [db...]\n")
 
     (opts, args) = parser.parse_args()
 
+    opts.dbs = [path for path in (opts.dbfrom, opts.dbto) if path] + args
+
     if len(args) > 1:
         opts.dbfrom = args.pop(0)
         opts.dbto = args.pop(0)
@@ -380,7 +881,20 @@ if __name__ == "__main__":
     level = logging_levels[opts.verbose if opts.verbose < 3 else 2]
     logging.basicConfig(level=level, format=_LOGGING_FMT_)
 
-    if not opts.dbfrom or not opts.dbto:
+    if opts.merge and len(opts.dbs) < 2:
+        parser.print_help()
+        error("Should provide at least two databases to merge")
+
+    if (opts.export or opts.import_from) and len(opts.dbs) != 1:
+        parser.print_help()
+        error("Should provide a single database to export or import")
+
+    if opts.catalog and not opts.dbs:
+        parser.print_help()
+        error("Should provide the databases to store in the catalog")
+
+    if not (opts.merge or opts.export or opts.import_from or opts.catalog) \
+       and (not opts.dbfrom or not opts.dbto):
         parser.print_help()
         error("Should provide Source and Destination databases")
 
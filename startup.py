@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Benchmarks the startup time of every script against a budget
+
+Each entry point is run several times and its best time is compared with the
+one of the bare interpreter, so the budget only counts what the script adds:
+mostly its imports. Exits with an error if any of them is over budget, to be
+run before committing.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+_HERE_ = os.path.dirname(os.path.abspath(__file__))
+
+# (name, arguments, budget in ms over the bare interpreter). {graph} is a
+# temporary copy of travel.yaml, so its compiled cache is kept out of the tree
+_ENTRY_POINTS_ = [
+    ('filediff', ['filediff/filediff.py', '--help'], 25),
+    ('lists', ['lists/list.py', '--help'], 50),
+    ('mp3hash', ['mp3hash/mp3hash.py', '--help'], 25),
+    ('music-bd', ['music-bd/banshee-clementine.py', '--help'], 40),
+    ('travel', ['travel/travel.py', '--help'], 50),
+    ('travel query', ['travel/travel.py', '{graph}', 'jerez', 'gatwick'], 60),
+]
+
+
+def best_time(command, runs):
+    "Returns the best seconds taken running command runs times"
+    best = None
+    with open(os.devnull, 'w') as devnull:
+        for run in xrange(runs):
+            start = time.time()
+            subprocess.call(command, stdout=devnull, stderr=devnull)
+            took = time.time() - start
+            best = took if best is None else min(best, took)
+    return best
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-n", "--runs", dest="runs", type="int", default=10,
+                      help="Runs of each entry point, the best one counts. "
+                      "Default 10")
+    parser.add_option("-p", "--python", dest="python",
+                      default=sys.executable,
+                      help="Interpreter running the scripts. Default this one")
+    parser.add_option("-s", "--scale", dest="scale", type="float",
+                      default=1.0, help="Multiplies every budget, for slower "
+                      "machines. Default 1")
+    opts, args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        graph = os.path.join(tmp, 'travel.yaml')
+        shutil.copy(os.path.join(_HERE_, 'travel', 'travel.yaml'), graph)
+
+        base = best_time([opts.python, '-c', 'pass'], opts.runs)
+        print "interpreter: {0:.1f}ms".format(base * 1000)
+
+        slow = 0
+        for name, arguments, budget in _ENTRY_POINTS_:
+            if args and name not in args:
+                continue
+
+            arguments = [arg.format(graph=graph) for arg in arguments]
+            command = [opts.python, os.path.join(_HERE_, arguments[0])] + \
+                arguments[1:]
+            best_time(command, 1)  # warms up disk and compiled caches
+            took = (best_time(command, opts.runs) - base) * 1000
+            budget *= opts.scale
+            slow += took > budget
+            print "{0}: {1:.1f}ms of {2:.0f}ms{3}".format(
+                name, took, budget, " OVER BUDGET" if took > budget else "")
+    finally:
+        shutil.rmtree(tmp)
+
+    if slow:
+        sys.exit("{0} entry points over budget".format(slow))
+
+if __name__ == "__main__":
+    main()
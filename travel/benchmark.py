@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Benchmarks travel.Graph.min_cost on synthetic graphs
+
+Compares it with the former search, which picked the next city with a linear
+scan over all the unvisited ones, and with the goal directed algorithms.
+"""
+import os
+import csv
+import time
+import random
+import shutil
+import tempfile
+from array import array
+from optparse import OptionParser
+
+from travel import Graph, _INF_, _ALGORITHMS_
+
+
+def quadratic_min_cost(graph, orig, dest):
+    "Returns the min cost from orig to dest scanning for the closest city"
+    orig, dest = graph.ids[orig], graph.ids[dest]
+    costs = {orig: 0}
+    nvisited = set(xrange(len(graph.names)))
+
+    while nvisited:
+        city = min(nvisited, key=lambda c: costs.get(c, _INF_))
+        if costs.get(city, _INF_) == _INF_:  # destination unreachable
+            break
+
+        nvisited.discard(city)
+        for edge in xrange(graph.offsets[city], graph.offsets[city + 1]):
+            neighbor = graph.targets[edge]
+            alt = costs[city] + graph.weights[edge]
+            if alt < costs.get(neighbor, _INF_):
+                costs[neighbor] = alt
+
+    return costs.get(dest, _INF_)
+
+
+def synthetic_graph(nodes, degree, seed):
+    """Returns a Graph of nodes cities placed at random in a square, each
+    connected both ways to its nearest degree cities by their distance,
+    alike a transport network. The square is 10 degrees wide, for astar.
+    """
+    rand = random.Random(seed)
+    places = [(rand.random(), rand.random()) for i in xrange(nodes)]
+    cells = int(max(1, (nodes / 4.0) ** 0.5))  # spatial grid, ~4 per cell
+    grid = dict()
+    for city, (x, y) in enumerate(places):
+        grid.setdefault((int(x * cells), int(y * cells)), []).append(city)
+
+    def near(city):
+        x, y = places[city]
+        cx, cy = int(x * cells), int(y * cells)
+        return [other for i in (-1, 0, 1) for j in (-1, 0, 1)
+                for other in grid.get((cx + i, cy + j), ()) if other != city]
+
+    edges = dict()
+    for city, (x, y) in enumerate(places):
+        dist = lambda o: ((places[o][0] - x) ** 2 + (places[o][1] - y) ** 2)
+        for other in sorted(near(city), key=dist)[:degree]:
+            cost = round(dist(other) ** 0.5 * 1000, 2)
+            edges[city, other] = edges[other, city] = cost
+
+    graph = Graph.from_edges((orig, dest, cost)
+                             for (orig, dest), cost in edges.iteritems())
+    graph.lats = array('d', [places[city][1] * 10 for city in graph.names])
+    graph.lons = array('d', [places[city][0] * 10 for city in graph.names])
+    return graph
+
+
+def compiled_check(graph, queries):
+    """Writes graph as a csv with non ascii names, reads it compiling it and
+    again from its compiled cache, and checks both give the same costs.
+    Returns the seconds taken reading the csv and loading the cache"""
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'graph.csv')
+        with open(path, 'wb') as efile:
+            writer = csv.writer(efile)
+            for node, name in enumerate(graph.names):
+                for edge in xrange(graph.offsets[node],
+                                   graph.offsets[node + 1]):
+                    writer.writerow(['münchen {0}'.format(name),
+                                     'münchen {0}'.format(
+                                         graph.names[graph.targets[edge]]),
+                                     repr(graph.weights[edge])])
+
+        start = time.time()
+        read = Graph(path)
+        read_time = time.time() - start
+        start = time.time()
+        loaded = Graph(path)
+        load_time = time.time() - start
+
+        assert read.names == loaded.names, "compiled names disagree"
+        for orig, dest in queries:
+            cost = graph.min_cost(orig, dest)[0]
+            orig, dest = 'münchen {0}'.format(orig), 'münchen {0}'.format(dest)
+            assert read.min_cost(orig, dest)[0] == cost and \
+                loaded.min_cost(orig, dest)[0] == cost, \
+                "compiled graph disagrees"
+    finally:
+        shutil.rmtree(tmp)
+    return read_time, load_time
+
+
+def timed(function, queries):
+    "Returns the results and seconds taken calling function for each query"
+    start = time.time()
+    results = [function(orig, dest) for orig, dest in queries]
+    return results, time.time() - start
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-n", "--nodes", dest="nodes", type="int",
+                      default=2000, help="Cities in the graph. Default 2000")
+    parser.add_option("-d", "--degree", dest="degree", type="int", default=3,
+                      help="Nearest cities connected to each one. Default 3")
+    parser.add_option("-q", "--queries", dest="queries", type="int",
+                      default=20, help="Queries timed. Default 20")
+    parser.add_option("-s", "--seed", dest="seed", type="int", default=0,
+                      help="Random seed. Default 0")
+    parser.add_option("-a", "--algorithms", dest="algorithms",
+                      default="dijkstra",
+                      help="Comma separated algorithms to time ({0}). "
+                      "Default dijkstra".format("|".join(_ALGORITHMS_)))
+    parser.add_option("-Q", "--no-quadratic", dest="quadratic",
+                      action="store_false", default=True,
+                      help="Don't time the quadratic search, too slow for "
+                      "big graphs")
+    opts, args = parser.parse_args()
+
+    start = time.time()
+    graph = synthetic_graph(opts.nodes, opts.degree, opts.seed)
+    print "graph: {0} cities {1} edges, built in {2:.2f}s"\
+        .format(len(graph.names), len(graph.targets), time.time() - start)
+
+    rand = random.Random(opts.seed)
+    queries = [(rand.randrange(opts.nodes), rand.randrange(opts.nodes))
+               for i in xrange(opts.queries)]
+
+    costs, heap_time = timed(lambda o, d: graph.min_cost(o, d)[0], queries)
+    print "heap: {0:.4f}s per query".format(heap_time / len(queries))
+
+    read_time, load_time = compiled_check(graph, queries)
+    print "compiled: csv read in {0:.2f}s, cache loaded in {1:.2f}s"\
+        .format(read_time, load_time)
+
+    ids = [(graph.ids[orig], graph.ids[dest]) for orig, dest in queries]
+    for algorithm in opts.algorithms.split(','):
+        if algorithm == 'alt':
+            start = time.time()
+            graph.prepare_landmarks(8)
+            print "alt: 8 landmarks in {0:.2f}s".format(time.time() - start)
+        if algorithm == 'astar':
+            start = time.time()
+            graph.astar_heuristic(0)
+            print "astar: points in {0:.2f}s".format(time.time() - start)
+
+        found, took = timed(lambda o, d: graph.find(o, d, algorithm), ids)
+        assert all(a == b or abs(a - b) < 1e-6
+                   for a, b in zip(costs, (cost for cost, p, s in found))),\
+            "searches disagree"
+        settled = sum(s for c, p, s in found) / float(len(found))
+        print "{0}: {1:.4f}s per query, {2:.1%} settled"\
+            .format(algorithm, took / len(found), settled / len(graph.names))
+
+    if 'astar' in opts.algorithms.split(','):
+        # Some places without coordinates, where astar can't estimate
+        mixed = synthetic_graph(opts.nodes, opts.degree, opts.seed)
+        for place in xrange(0, len(mixed.names), 3):
+            mixed.lats[place] = mixed.lons[place] = float('nan')
+        found, took = timed(lambda o, d: mixed.find(o, d, 'astar'), ids)
+        assert all(a == b or abs(a - b) < 1e-6
+                   for a, b in zip(costs, (cost for cost, p, s in found))),\
+            "searches disagree with places without coordinates"
+        print "astar mixed coordinates: {0:.4f}s per query"\
+            .format(took / len(found))
+
+    if opts.quadratic:
+        slow, slow_time = timed(lambda o, d: quadratic_min_cost(graph, o, d),
+                                queries)
+        assert all(a == b or abs(a - b) < 1e-6 for a, b in zip(slow, costs)),\
+            "searches disagree"
+        print "quadratic: {0:.4f}s per query".format(slow_time / len(queries))
+        print "speedup: {0:.1f}x".format(slow_time / heap_time)
+
+if __name__ == "__main__":
+    main()
@@ -5,13 +5,39 @@ Dijkstra travel map
 
 Javier Santacruz 2012-07-31
 """
+import os
 import sys
-import yaml
+import csv
+import json
+import math
+import mmap
+import time
+import heapq
+import hashlib
 import logging
-from collections import defaultdict
+import itertools
+import threading
+from array import array
+from collections import OrderedDict, deque
 from optparse import OptionParser
 
+numpy = None  # imported on first use, see load_numpy
+
 _LOGGING_FMT_ = '%(asctime)s %(levelname)-8s %(message)s'
+_INF_ = float('inf')
+_TABLE_FORMAT_ = 'travel-routes'  # header of all-pairs tables, see RouteTable
+_TABLE_VERSION_ = 1
+_EXACT_STOPS_ = 15  # max stops for held_karp
+_NUMPY_STOPS_ = 20  # max stops for held_karp when numpy is available
+_WORKER_ = dict()  # graph and stops in cost_matrix worker processes
+_GRAPH_FORMAT_ = 'travel-graph'  # header of compiled graphs, see Graph.save
+_GRAPH_VERSION_ = 4
+_DELIMITERS_ = {'.csv': ',', '.tsv': '\t'}  # edge lists, see csv_edges
+_EARTH_RADIUS_ = 6371.0  # km
+_ALGORITHMS_ = ('dijkstra', 'bidirectional', 'astar', 'alt')
+_LANDMARKS_ = 8  # default landmarks for alt
+_LATENCIES_ = 1000  # last query latencies kept for Server.stats
+_LABELS_ = 64  # max routes kept per place in pareto searches
 
 
 def error(msg, is_exit=True):
@@ -20,13 +46,31 @@ def error(msg, is_exit=True):
         sys.exit()
 
 
+def load_numpy():
+    """Returns the numpy module, or None if it isn't installed
+    Imported on first use, as it takes longer than answering most queries.
+    """
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+    return numpy or None
+
+
 def open_yaml(yaml_path):
-    "Opens and returns the yaml file"
+    """Opens and returns the yaml file
+    Uses the libyaml loader when available, which is much faster.
+    yaml is imported here, as compiled graphs don't need it"""
+    import yaml
+
     yfile = None
     try:
         with open(yaml_path, 'r') as gfile:
-            yfile = yaml.load(gfile, Loader=yaml.Loader)
-    except yaml.error.YAMLError, e:
+            yfile = yaml.load(gfile, Loader=getattr(yaml, 'CLoader',
+                                                    yaml.Loader))
+    except (yaml.error.YAMLError, IOError), e:
         logging.error('Could not open the graph file {0}: {1}'
                       .format(yaml_path, e))
 
@@ -37,12 +81,122 @@ def open_yaml(yaml_path):
     return yfile
 
 
+def yaml_edges(yfile):
+    """Yields (origin, dest, cost) for every connection in a graph yaml
+    cost is a dict when the connection has several criteria.
+    Wrong connections are reported as errors"""
+    for origin, dests in yfile.iteritems():
+        if isinstance(dests, dict):
+            dests = dests.get('to')
+        if dests is not None and not isinstance(dests, list):
+            error("Wrong connections from {0}: {1}".format(origin, dests))
+        for dest in dests or []:
+            if not isinstance(dest, dict):
+                error("Wrong connection from {0}: {1}".format(origin, dest))
+            for to, cost in dest.iteritems():
+                values = cost.items() if isinstance(cost, dict) else \
+                    [('cost', cost)]
+                for name, value in values:
+                    if isinstance(value, bool) or \
+                       not isinstance(value, (int, long, float)):
+                        error("Wrong {0} from {1} to {2}: {3}"
+                              .format(name, origin, to, value))
+                yield origin, to, cost
+
+
+def yaml_coords(yfile):
+    "Yields (place, latitude, longitude) for every place with coords"
+    for place, dests in yfile.iteritems():
+        if isinstance(dests, dict) and dests.get('coords'):
+            try:
+                latitude, longitude = dests['coords']
+            except (TypeError, ValueError):
+                error("Wrong coords for {0}: {1}"
+                      .format(place, dests['coords']))
+            yield place, float(latitude), float(longitude)
+
+
+def unit_point(latitude, longitude):
+    "Returns the (x, y, z) point of the coordinates in a sphere of radius 1"
+    lat, lon = math.radians(latitude), math.radians(longitude)
+    return math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), \
+        math.sin(lat)
+
+
+def csv_edges(path):
+    """Yields (origin, dest, cost) for every row in a csv or tsv file
+    A first row without a numeric cost is taken as a header. If it names
+    more columns after the cost, like duration, cost is a dict with all of
+    them, as in yaml_edges."""
+    delimiter = _DELIMITERS_.get(os.path.splitext(path)[1].lower(), ',')
+    criteria = []
+    try:
+        with open(path, 'rb') as efile:
+            for line, row in enumerate(csv.reader(efile, delimiter=delimiter)):
+                if not row:
+                    continue
+                try:
+                    if not criteria:
+                        yield row[0], row[1], float(row[2])
+                    else:
+                        yield row[0], row[1], dict(
+                            (name, float(value))
+                            for name, value in zip(criteria, row[2:]))
+                except (IndexError, ValueError):
+                    if line == 0 and len(row) > 3:
+                        criteria = ['cost'] + row[3:]
+                    if line > 0:
+                        error("Wrong edge in {0}, line {1}: {2}"
+                              .format(path, line + 1, row))
+    except (IOError, csv.Error), err:
+        error("Couldn't read the graph in {0}: {1}".format(path, err))
+
+
+def ascii_str(text):
+    "Returns unicode text as str if it's ascii, as yaml and csv give them"
+    if isinstance(text, unicode):
+        try:
+            return text.encode('ascii')
+        except UnicodeEncodeError:
+            pass
+    return text
+
+
+def non_ascii_bytes(text):
+    "Returns True if text is a str with non ascii bytes, as csv gives them"
+    if isinstance(text, str):
+        try:
+            text.decode('ascii')
+        except UnicodeDecodeError:
+            return True
+    return False
+
+
+def file_stamp(path):
+    "Returns the (mtime, size) of the file in path"
+    fstat = os.stat(path)
+    return fstat.st_mtime, fstat.st_size
+
+
+def file_digest(path):
+    "Returns the md5 hexdigest of the contents of the file in path"
+    digest = hashlib.md5()
+    with open(path, 'rb') as dfile:
+        for block in iter(lambda: dfile.read(1 << 20), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
 class Graph(object):
     """
     Class to hold the graph and perform operations on it.
     """
 
-    def __init__(self, graph_path):
+    # Arrays stored in compiled graphs, with their typecodes
+    _ARRAYS = (('offsets', 'l'), ('targets', 'i'), ('weights', 'd'),
+               ('lats', 'd'), ('lons', 'd'))
+
+    def __init__(self, graph_path=None, cache=True):
         """
         Reads the graph config file in yaml
         The yaml should look like:
@@ -51,71 +205,1406 @@ class Graph(object):
                 - 'other_place': cost
 
         Omitted origin-dest pairs will set the connection as unreachable.
+        Places may also have their coordinates, for astar queries:
 
-        returns graph as a dictionary:
-            {
-            'from': {
-                'to_1': cost,
-                'to_2': cost ..
-                }
-            ..
-            }
-        """
-        # The graph is a dict of connection dicts
-        # The connection dicts returns infinite for not connected cities
-        # The graph returns an empty connection dict for non existent cities
-        inf = lambda: float('inf')
-        dict_inf = lambda: defaultdict(inf)
-
-        self.graph = defaultdict(dict_inf)
-        for origin, dests in open_yaml(graph_path).iteritems():
-            ddict = dict()
-            for d in dests:
-                ddict.update(d.items())
-            self.graph[origin] = defaultdict(inf, ddict)
+            'place':
+                coords: [latitude, longitude]
+                to:
+                    - 'other_place': cost
 
-    def min_cost(self, orig, dest):
+        And connections may have other criteria than cost, for pareto:
+
+            'place':
+                - 'other_place': {cost: 10, duration: 2.5, transfers: 1}
+
+        Files ending in .csv or .tsv are read as edge lists instead, with
+        rows like: place,other_place,cost
+
+        Places are numbered in ids and names, and the graph is stored as
+        compressed sparse rows (see compile) so searches run on flat arrays.
+        If cache is set, the compiled graph is saved next to the file, and
+        loaded instead of reading the file again while it doesn't change.
         """
-        Takes strings orig, dest (both in graph)
-        Returns (min cost, path-list)
+        self.ids = dict()  # name -> id
+        self.names = []  # id -> name
+        self.offsets = array('l', [0])
+        self.targets = array('i')
+        self.weights = array('d')
+        self.lats = array('d')  # coordinates by id, nan if unknown
+        self.lons = array('d')
+        self.criteria = dict()  # name -> values by edge, as weights
+        self.lock = threading.RLock()  # for the lazily prepared data
+        self.reverse = None  # offsets, sources and weights of incoming edges
+        self.points = None  # x, y, z arrays of places, see astar_heuristic
+        self.scale = None
+        self.landmarks = []  # (costs from, costs to) landmarks, see alt
+        if graph_path is None:
+            return
+
+        cache_path = "{0}.cache".format(graph_path)
+        if cache and os.path.exists(cache_path) and \
+           self.load(cache_path, graph_path):
+            logging.debug("Loaded compiled graph {0}".format(cache_path))
+            return
+
+        self.read(graph_path)
+        if cache:
+            try:
+                self.save(cache_path, graph_path)
+            except (IOError, OSError), err:
+                logging.info("Couldn't save compiled graph {0}: {1}"
+                             .format(cache_path, err))
+
+    def read(self, graph_path):
+        "Reads the graph in graph_path, in yaml or csv"
+        if os.path.splitext(graph_path)[1].lower() in _DELIMITERS_:
+            self.compile(csv_edges(graph_path))
+            return
+
+        yfile = open_yaml(graph_path)
+        if yfile is None:
+            error("Couldn't load the graph in {0}".format(graph_path))
+
+        for origin in yfile:
+            self.add_node(origin)
+        self.compile(yaml_edges(yfile))
+
+        coords = list(yaml_coords(yfile))
+        if coords:
+            self.lats = array('d', [float('nan')]) * len(self.names)
+            self.lons = array('d', [float('nan')]) * len(self.names)
+            for place, latitude, longitude in coords:
+                self.lats[self.ids[place]] = latitude
+                self.lons[self.ids[place]] = longitude
+
+    def save(self, path, source):
+        """
+        Writes the compiled graph to path, as a json header line identifying
+        the source file and listing the arrays, a json line with the names,
+        and the arrays in machine order.
+        Names given as non ascii byte strings are written as latin-1, and
+        listed in the header to be read back as the same bytes.
+        """
+        encoded = [node for node, name in enumerate(self.names)
+                   if non_ascii_bytes(name)]
+        names = list(self.names)
+        for node in encoded:
+            names[node] = names[node].decode('latin-1')
+
+        arrays = [(name, getattr(self, name)) for name, typecode in self._ARRAYS]
+        arrays.extend(("criterion:" + name, values)
+                      for name, values in self.criteria.iteritems())
+        mtime, size = file_stamp(source)
+        header = {'format': _GRAPH_FORMAT_, 'version': _GRAPH_VERSION_,
+                  'mtime': mtime, 'size': size, 'md5': file_digest(source),
+                  'encoded': encoded,
+                  'arrays': [(name, values.typecode, len(values))
+                             for name, values in arrays]}
+
+        tmp_path = "{0}.tmp".format(path)
+        with open(tmp_path, 'wb') as gfile:
+            gfile.write(json.dumps(header) + '\n')
+            gfile.write(json.dumps(names) + '\n')
+            for name, values in arrays:
+                gfile.write(values.tostring())
+        os.rename(tmp_path, path)
+
+    def load(self, path, source):
+        """
+        Loads the compiled graph in path, memory mapping it.
+        Returns False if it isn't a compiled graph of the source file as it
+        is now: with another modification time and size, and contents.
+        If only the time or size changed, it's saved again with them, so
+        the source isn't hashed on every load.
+        """
+        restamp = False
+        try:
+            with open(path, 'rb') as gfile:
+                data = mmap.mmap(gfile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, mmap.error), err:
+            logging.info("Couldn't open compiled graph {0}: {1}"
+                         .format(path, err))
+            return False
+
+        try:
+            header = json.loads(data.readline())
+            if header.get('format') != _GRAPH_FORMAT_ or \
+               header.get('version') != _GRAPH_VERSION_:
+                return False
+
+            if (header['mtime'], header['size']) != file_stamp(source):
+                if header['md5'] != file_digest(source):
+                    return False
+                restamp = True
+
+            names = [ascii_str(name)
+                     for name in json.loads(data.readline())]
+            for node in header['encoded']:
+                names[node] = names[node].encode('latin-1')
+            position = data.tell()
+            arrays = dict()
+            for name, typecode, length in header['arrays']:
+                arrays[name] = array(typecode)
+                end = position + length * arrays[name].itemsize
+                arrays[name].fromstring(data[position:end])
+                if len(arrays[name]) != length:
+                    return False
+                position = end
+        except (ValueError, KeyError, TypeError, IndexError,
+                UnicodeError), err:
+            logging.info("Wrong compiled graph {0}: {1}".format(path, err))
+            return False
+        finally:
+            data.close()
+
+        self.names = names
+        self.ids = dict(itertools.izip(names, itertools.count()))
+        for name, typecode in self._ARRAYS:
+            setattr(self, name, arrays.pop(name))
+        self.criteria = dict((name.split(':', 1)[1], values)
+                             for name, values in arrays.iteritems())
+
+        if restamp:
+            try:
+                self.save(path, source)
+            except (IOError, OSError), err:
+                logging.info("Couldn't update compiled graph {0}: {1}"
+                             .format(path, err))
+        return True
+
+    @classmethod
+    def from_edges(cls, edges):
+        "Returns a new graph with (origin, dest, cost) edges"
+        graph = cls()
+        graph.compile(edges)
+        return graph
+
+    def add_node(self, name):
+        "Returns the id for the place name, numbering it if new"
+        node = self.ids.get(name)
+        if node is None:
+            node = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return node
+
+    def compile(self, edges):
+        """
+        Sets the graph connections to (origin, dest, cost) edges
+        The edges from the place with id i are stored from offsets[i] to
+        offsets[i + 1] in targets, with the id of the place they reach, and
+        in weights, with their cost. Edges repeated keep the cheapest.
+        If cost is a dict, its 'cost' is the cost, and any other values are
+        kept by name in criteria, as weights. Missing values are 0.
+        """
+        add_node = self.add_node
+        origins, targets, weights = array('i'), array('i'), array('d')
+        criteria = dict()
+        for origin, dest, cost in edges:
+            origins.append(add_node(origin))
+            targets.append(add_node(dest))
+            if isinstance(cost, dict):
+                for name, value in cost.iteritems():
+                    if name != 'cost':
+                        if name not in criteria:
+                            criteria[name] = array('d', [0]) * len(weights)
+                        criteria[name].append(value)
+                cost = cost.get('cost', 0)
+            weights.append(cost)
+            for values in criteria.itervalues():
+                if len(values) < len(weights):
+                    values.append(0)
+
+        names = criteria.keys()
+        rows = sparse_rows(len(self.names), origins, targets, weights,
+                           *[criteria[name] for name in names])
+        self.offsets, self.targets, self.weights = rows[:3]
+        self.criteria = dict(zip(names, rows[3:]))
+
+    def reversed(self):
+        """
+        Returns (offsets, sources, weights) for the edges reaching each place,
+        as compile does for the edges leaving them. Built on first use.
         """
-        # Dist from orig to x
-        costs = defaultdict(lambda: float('inf'), {orig: 0})
-        prev = defaultdict()
-        graph = self.graph
-        nvisited = set(graph.keys())
+        with self.lock:
+            if self.reverse is None:
+                self.reverse = sparse_rows(len(self.names), self.targets,
+                                           self.origins(), self.weights)
+        return self.reverse
 
-        while nvisited:
-            city = min(nvisited, key=lambda c: costs[c])
+    def origins(self):
+        "Returns the array of the place ids each edge leaves, by edge"
+        origins = array('i')
+        for node in xrange(len(self.names)):
+            origins.extend([node] * (self.offsets[node + 1] -
+                                     self.offsets[node]))
+        return origins
 
-            if costs[city] == float('inf'):  # destination unreachable
+    def digest(self):
+        "Returns a hash of the places and connections in the graph"
+        digest = hashlib.md5(json.dumps(self.names))
+        for data in (self.offsets, self.targets, self.weights):
+            digest.update(data.tostring())
+        return digest.hexdigest()
+
+    def search(self, source, target=None, reverse=False, rows=None):
+        """
+        Dijkstra from the source id with a binary heap. Places are pushed
+        again when a cheaper way is found, and the stale entries are skipped
+        when popped. If target is given, stops as soon as it's popped.
+        With reverse, follows the edges backwards, to get the costs to source.
+        rows, as (offsets, targets, weights), replace the edges if given.
+        Returns (costs, prev) arrays by id, with the min cost from source and
+        the previous place in the way, -1 if unreachable.
+        """
+        if rows:
+            offsets, targets, weights = rows
+        elif reverse:
+            offsets, targets, weights = self.reversed()
+        else:
+            offsets, targets, weights = self.offsets, self.targets, self.weights
+        costs = array('d', [_INF_]) * len(self.names)
+        prev = array('i', [-1]) * len(self.names)
+        costs[source] = 0
+        heap = [(0, source)]
+        heappop, heappush = heapq.heappop, heapq.heappush
+
+        while heap:
+            cost, node = heappop(heap)
+            if node == target:
                 break
 
-            neighbours = graph[city]
-            nvisited.discard(city)  # mark as visited
+            if cost > costs[node]:  # stale entry, already settled
+                continue
+
+            for edge in xrange(offsets[node], offsets[node + 1]):
+                neighbor = targets[edge]
+                alt = cost + weights[edge]
+                if alt < costs[neighbor]:
+                    costs[neighbor] = alt
+                    prev[neighbor] = node
+                    heappush(heap, (alt, neighbor))
+
+        return costs, prev
+
+    def min_cost(self, orig, dest, algorithm='dijkstra'):
+        """
+        Takes strings orig, dest (both in graph)
+        Returns (min cost, path-list), (inf, []) if dest is unreachable
+        The algorithm is one of _ALGORITHMS_, see find.
+        """
+        if orig == dest:
+            return 0, [orig]
+
+        source, target = self.ids.get(orig), self.ids.get(dest)
+        if source is None or target is None:
+            return _INF_, []
+
+        cost, path, settled = self.find(source, target, algorithm)
+        return cost, [self.names[node] for node in path]
+
+    def find(self, source, target, algorithm='dijkstra'):
+        """
+        Returns (min cost, path of ids, places settled) from source to
+        target ids, (inf, [], places settled) if unreachable, with:
+            dijkstra - stopping as soon as target is reached
+            bidirectional - searching from both ends until they meet
+            astar - aiming at target by the coordinates of places
+            alt - aiming at target by the costs to and from landmarks
+        """
+        if algorithm == 'bidirectional':
+            return self.bidirectional(source, target)
+        if algorithm == 'astar':
+            return self.astar(source, target, self.astar_heuristic(target))
+        if algorithm == 'alt':
+            return self.astar(source, target, self.alt_heuristic(target))
+        return self.astar(source, target)
+
+    def astar(self, source, target, heuristic=None):
+        """
+        A*: Dijkstra from the source id, but popping first the places with
+        the least cost plus heuristic(place), an estimate never above the
+        cost from place to target. Places estimated as inf are left out.
+        Without heuristic, it's plain Dijkstra stopping at target.
+        Returns (min cost, path of ids, places settled), see find.
+        """
+        offsets, targets, weights = self.offsets, self.targets, self.weights
+        costs = array('d', [_INF_]) * len(self.names)
+        prev = array('i', [-1]) * len(self.names)
+        estimates = dict()
+        costs[source] = 0
+        heap = [(0, 0, source)]
+        heappop, heappush = heapq.heappop, heapq.heappush
+        settled = 0
+
+        while heap:
+            rank, cost, node = heappop(heap)
+            if cost > costs[node]:  # stale entry
+                continue
 
-            for neighbor in neighbours:
-                alt = costs[city] + graph[city][neighbor]
+            settled += 1
+            if node == target:
+                return cost, self.path_ids(source, target, prev), settled
+
+            for edge in xrange(offsets[node], offsets[node + 1]):
+                neighbor = targets[edge]
+                alt = cost + weights[edge]
                 if alt < costs[neighbor]:
+                    estimate = 0
+                    if heuristic is not None:
+                        estimate = estimates.get(neighbor)
+                        if estimate is None:
+                            estimate = estimates[neighbor] = heuristic(neighbor)
+                        if estimate == _INF_:  # can't reach target
+                            continue
+                    costs[neighbor] = alt
+                    prev[neighbor] = node
+                    heappush(heap, (alt + estimate, alt, neighbor))
+
+        return _INF_, [], settled
+
+    def bidirectional(self, source, target):
+        """
+        Dijkstra from source forwards and from target backwards, advancing
+        the one with the cheapest place to pop each time, until no way
+        through the places not yet popped can beat the cheapest found
+        through a place reached from both sides.
+        Returns (min cost, path of ids, places settled), see find.
+        """
+        places = len(self.names)
+        sides = ((self.offsets, self.targets, self.weights), self.reversed())
+        costs = (array('d', [_INF_]) * places, array('d', [_INF_]) * places)
+        prev = (array('i', [-1]) * places, array('i', [-1]) * places)
+        heaps = ([(0, source)], [(0, target)])
+        costs[0][source] = costs[1][target] = 0
+        heappop, heappush = heapq.heappop, heapq.heappush
+        best, meeting, settled = _INF_, -1, 0
+
+        while heaps[0] and heaps[1]:
+            if heaps[0][0][0] + heaps[1][0][0] >= best:
+                break
+
+            side = 0 if heaps[0][0][0] <= heaps[1][0][0] else 1
+            cost, node = heappop(heaps[side])
+            if cost > costs[side][node]:  # stale entry
+                continue
+
+            settled += 1
+            offsets, targets, weights = sides[side]
+            mine, others = costs[side], costs[1 - side]
+            for edge in xrange(offsets[node], offsets[node + 1]):
+                neighbor = targets[edge]
+                alt = cost + weights[edge]
+                if alt < mine[neighbor]:
+                    mine[neighbor] = alt
+                    prev[side][neighbor] = node
+                    heappush(heaps[side], (alt, neighbor))
+                    if alt + others[neighbor] < best:
+                        best, meeting = alt + others[neighbor], neighbor
+
+        if meeting < 0:
+            return (0, [source], settled) if source == target \
+                else (_INF_, [], settled)
+
+        path = self.path_ids(source, meeting, prev[0])
+        node = meeting
+        while node != target:
+            node = prev[1][node]
+            path.append(node)
+        return best, path, settled
+
+    def astar_heuristic(self, target):
+        """
+        Returns the astar heuristic for target: the straight distance to it
+        through the Earth times the lowest cost per km of any connection, so
+        it never overestimates. Returns None, for plain Dijkstra, unless
+        every place has coordinates, as a way through a place without them
+        could cost less than any estimate.
+        """
+        if not self.lats:
+            return
+
+        with self.lock:
+            if self.points is None:
+                self.prepare_points()
+
+        if self.scale is None:
+            return
+
+        xs, ys, zs = self.points
+        x, y, z, scale = xs[target], ys[target], zs[target], self.scale
+
+        def heuristic(node):
+            return scale * math.sqrt((xs[node] - x) ** 2 +
+                                     (ys[node] - y) ** 2 + (zs[node] - z) ** 2)
+        return heuristic
+
+    def prepare_points(self):
+        """
+        Sets the points of places for astar_heuristic, in a sphere of the
+        size of the Earth, and the lowest cost per km between them, None if
+        some place has no coordinates.
+        """
+        xs, ys, zs = array('d'), array('d'), array('d')
+        for latitude, longitude in itertools.izip(self.lats, self.lons):
+            for axis, value in zip((xs, ys, zs),
+                                   unit_point(latitude, longitude)):
+                axis.append(value * _EARTH_RADIUS_)
+
+        scale = _INF_
+        for node in xrange(len(self.names)):
+            for edge in xrange(self.offsets[node], self.offsets[node + 1]):
+                dest = self.targets[edge]
+                km = math.sqrt((xs[node] - xs[dest]) ** 2 +
+                               (ys[node] - ys[dest]) ** 2 +
+                               (zs[node] - zs[dest]) ** 2)
+                if km > 0:  # and not nan
+                    scale = min(scale, self.weights[edge] / km)
+
+        self.scale = scale if scale < _INF_ else 0
+        if any(math.isnan(x) for x in xs):
+            logging.info("Some places have no coordinates, astar searches "
+                         "will be plain dijkstra")
+            self.scale = None
+        self.points = xs, ys, zs
+
+    def prepare_landmarks(self, count):
+        """
+        Picks count landmarks, each as far as possible from the ones before,
+        and keeps the costs from and to each of them for alt. Landmarks get
+        picked only once per graph.
+        """
+        with self.lock:
+            if self.landmarks or not self.names:
+                return
+
+            logging.info("Preparing {0} landmarks".format(count))
+            closest = self.search(0)[0]  # cost from the closest landmark
+            for i in xrange(min(count, len(self.names))):
+                landmark = max(xrange(len(self.names)),
+                               key=lambda node: closest[node]
+                               if closest[node] < _INF_ else -1)
+                from_landmark = self.search(landmark)[0]
+                to_landmark = self.search(landmark, reverse=True)[0]
+                self.landmarks.append((from_landmark, to_landmark))
+                if i == 0:  # the first one is just far from place 0
+                    closest = from_landmark
+                else:
+                    closest = array('d', itertools.imap(min, closest,
+                                                        from_landmark))
+
+    def alt_heuristic(self, target):
+        """
+        Returns the alt heuristic for target: by the triangle inequality,
+        the cost from a place to target is never below the difference of
+        their costs from or to any landmark. See prepare_landmarks.
+        """
+        self.prepare_landmarks(_LANDMARKS_)
+        bounds = [(from_landmark, from_landmark[target], to_landmark,
+                   to_landmark[target])
+                  for from_landmark, to_landmark in self.landmarks]
+
+        def heuristic(node):
+            estimate = 0
+            for from_landmark, from_target, to_landmark, to_target in bounds:
+                if from_landmark[node] < _INF_:
+                    estimate = max(estimate, from_target - from_landmark[node])
+                if to_target < _INF_:
+                    estimate = max(estimate, to_landmark[node] - to_target)
+            return estimate
+        return heuristic
+
+    def route(self, source, target, costs, prev):
+        """
+        Returns (min cost, path-list) from source to target ids given the
+        costs and previous places from source, (inf, []) if unreachable
+        """
+        if costs[target] == _INF_:
+            return _INF_, []
+
+        return costs[target], self.path(source, target, prev)
+
+    def k_shortest(self, source, target, k):
+        """
+        Yen's algorithm: returns up to k (cost, path of ids) routes without
+        loops from source to target ids, cheapest first. Every route found
+        is deviated from at each of its places, searching the rest of the
+        way without the places before and the ways already taken. Only
+        the cheapest deviations that could still be among k are kept.
+        The costs to target without restrictions, from a backwards search,
+        guide those searches and give the cheapest route.
+        """
+        remaining, following = self.search(target, reverse=True)
+        if remaining[source] == _INF_:
+            return []
+
+        path = [source]
+        while path[-1] != target:
+            path.append(following[path[-1]])
+
+        found = [(remaining[source], path)]
+        candidates, seen = [], set([tuple(path)])
+        while len(found) < k:
+            last = found[-1][1]
+            root_cost = 0
+            for i in xrange(len(last) - 1):
+                root = last[:i + 1]
+                taken = set(path[i + 1] for cost, path in found
+                            if path[:i + 1] == root)
+                cost, spur = self.spur_search(last[i], target, set(root[:-1]),
+                                              taken, remaining)
+                if spur and tuple(root[:-1] + spur) not in seen:
+                    seen.add(tuple(root[:-1] + spur))
+                    heapq.heappush(candidates,
+                                   (root_cost + cost, root[:-1] + spur))
+                root_cost += self.edge_cost(last[i], last[i + 1])
+
+            if not candidates:
+                break
+            if len(candidates) > k - len(found):
+                candidates = heapq.nsmallest(k - len(found), candidates)
+            found.append(heapq.heappop(candidates))
+
+        return found
+
+    def spur_search(self, source, target, banned, taken, remaining):
+        """
+        Returns (min cost, path of ids) from source to target ids without
+        going through banned places nor from source to the taken places,
+        (inf, []) if unreachable. An astar with the remaining costs to
+        target as heuristic, which are exact but for the restrictions, so
+        it reaches few places and keeps them in dicts.
+        """
+        offsets, targets, weights = self.offsets, self.targets, self.weights
+        costs, prev = {source: 0}, dict()
+        heap = [(remaining[source], 0, source)]
+        while heap:
+            estimate, cost, node = heapq.heappop(heap)
+            if node == target:
+                return cost, self.path_ids(source, target, prev)
+            if cost > costs[node]:  # stale entry
+                continue
+
+            for edge in xrange(offsets[node], offsets[node + 1]):
+                neighbor = targets[edge]
+                if neighbor in banned or (node == source and neighbor in taken) \
+                        or remaining[neighbor] == _INF_:
+                    continue
+                alt = cost + weights[edge]
+                if alt < costs.get(neighbor, _INF_):
                     costs[neighbor] = alt
-                    prev[neighbor] = city
+                    prev[neighbor] = node
+                    heapq.heappush(heap,
+                                   (alt + remaining[neighbor], alt, neighbor))
+
+        return _INF_, []
+
+    def edge_cost(self, orig, dest):
+        "Returns the cost of the cheapest edge from orig to dest ids"
+        return min(self.weights[edge]
+                   for edge in xrange(self.offsets[orig], self.offsets[orig + 1])
+                   if self.targets[edge] == dest)
+
+    def pareto(self, source, target, criteria, limit=_LABELS_):
+        """
+        Returns the routes from source to target ids which no other beats
+        in all the criteria, as [(values, path of ids)], with the values
+        of each criteria (names in self.criteria, 'cost' or 'hops').
+        Routes are extended in lexicographic order of their values plus
+        the min values left to target by each criteria alone, and dropped
+        as soon as another route to the same place is as good in every
+        criteria, or a route to target is as good as the best they could
+        get. At most limit routes are kept for each place, so some routes
+        may be missed when it's reached.
+        """
+        columns = []
+        for name in criteria:
+            if name == 'cost':
+                columns.append(self.weights)
+            elif name == 'hops':
+                columns.append(array('d', [1]) * len(self.targets))
+            elif name in self.criteria:
+                columns.append(self.criteria[name])
+            else:
+                raise ValueError("Unknown criteria {0}".format(name))
+
+        origins = self.origins()
+        bounds = []  # min values to target by each criteria
+        for column in columns:
+            rows = sparse_rows(len(self.names), self.targets, origins, column)
+            bounds.append(self.search(target, rows=rows)[0])
+        if bounds[0][source] == _INF_:
+            return []
+
+        def beaten(values, others):
+            for other in others:
+                if all(a <= b for a, b in zip(labels[other][0], values)):
+                    return True
+            return False
+
+        offsets, targets = self.offsets, self.targets
+        start = (0,) * len(columns)
+        labels = [(start, source, -1)]  # values, place, previous label
+        alive = {source: [0]}  # place -> labels not beaten
+        dead = set()
+        heap = [(start, 0)]
+        found, full = [], False
+        while heap:
+            estimate, label = heapq.heappop(heap)
+            if label in dead:
+                continue
+            values, node = labels[label][:2]
+            if node == target:
+                found.append(label)
+                continue
+
+            for edge in xrange(offsets[node], offsets[node + 1]):
+                neighbor = targets[edge]
+                if bounds[0][neighbor] == _INF_:
+                    continue
+                new = tuple(value + column[edge]
+                            for value, column in zip(values, columns))
+                estimate = tuple(value + bound[neighbor]
+                                 for value, bound in zip(new, bounds))
+                others = alive.setdefault(neighbor, [])
+                if beaten(estimate, alive.get(target, ())) or \
+                        beaten(new, others):
+                    continue
+
+                for other in others:
+                    if all(a <= b for a, b in zip(new, labels[other][0])):
+                        dead.add(other)
+                others[:] = [other for other in others if other not in dead]
+                if len(others) >= limit:
+                    full = True
+                    continue
+
+                others.append(len(labels))
+                labels.append((new, neighbor, label))
+                heapq.heappush(heap, (estimate, len(labels) - 1))
 
-        return costs[dest], self.path(orig, dest, prev)
+        if full:
+            logging.warning("Some places had more than {0} routes, some "
+                            "routes may be missing".format(limit))
+
+        routes = []
+        for label in found:
+            values, path = labels[label][0], []
+            while label >= 0:
+                path.append(labels[label][1])
+                label = labels[label][2]
+            routes.append((values, path[::-1]))
+        return routes
 
     def path(self, orig, dest, previous):
         """
-        Returns the path from origin to dest
+        Returns the path of place names from origin to dest ids
+        """
+        return [self.names[node] for node in self.path_ids(orig, dest,
+                                                             previous)]
+
+    def path_ids(self, orig, dest, previous):
+        """
+        Returns the path of place ids from origin to dest ids
         """
         path = []
-        city = dest
-        while city != orig:
-            path.insert(0, city)
-            city = previous[city]
+        node = dest
+        while node != orig:
+            path.append(node)
+            node = previous[node]
 
-        path.insert(0, orig)
+        path.append(orig)
+        path.reverse()
         return path
 
 
+def alternatives(graph, orig, dest, k=1, criteria=None, limit=_LABELS_):
+    """
+    Returns the routes from orig to dest names as [(values, path-list)]:
+    the k cheapest, with values (cost,), or else the pareto routes by
+    criteria, with a value for each one. See Graph.k_shortest and pareto.
+    """
+    source, target = graph.ids.get(orig), graph.ids.get(dest)
+    if source is None or target is None:
+        return []
+
+    if criteria:
+        routes = graph.pareto(source, target, criteria, limit)
+    else:
+        routes = [((cost,), path)
+                  for cost, path in graph.k_shortest(source, target, k)]
+    return [(values, [graph.names[node] for node in path])
+            for values, path in routes]
+
+
+def sparse_rows(places, origins, targets, *weights):
+    """
+    Returns (offsets, targets, weights...) arrays with the edges sorted by
+    origin, so the edges from place i go from offsets[i] to offsets[i + 1]
+    """
+    # Count the edges from each place, and place each one in its row
+    offsets = array('l', [0]) * (places + 1)
+    for origin in origins:
+        offsets[origin + 1] += 1
+    for node in xrange(places):
+        offsets[node + 1] += offsets[node]
+
+    order = array('l', [0]) * len(targets)  # row of every edge
+    position = offsets[:-1]
+    for edge, origin in enumerate(origins):
+        order[edge] = position[origin]
+        position[origin] += 1
+
+    sorted_rows = [offsets]
+    for values in (targets,) + weights:
+        rows = array(values.typecode, [0]) * len(values)
+        for edge, row in enumerate(order):
+            rows[row] = values[edge]
+        sorted_rows.append(rows)
+    return tuple(sorted_rows)
+
+
+class Routes(object):
+    """
+    Answers min_cost queries on a graph, looking them up in a RouteTable if
+    given, or else in the shortest path trees from the last size origins.
+    If an algorithm is given (see Graph.find), queries from origins not
+    cached are searched with it instead of building their trees.
+    """
+
+    def __init__(self, graph, size=64, table=None, algorithm=None):
+        self.graph = graph
+        self.size = size
+        self.table = table
+        self.algorithm = algorithm
+        self.trees = OrderedDict()  # source -> (costs, prev), oldest first
+        self.lock = threading.Lock()  # for trees
+
+    def tree(self, source):
+        "Returns (costs, prev) for all the places from the source id"
+        with self.lock:
+            tree = self.trees.pop(source, None)
+            if tree is not None:
+                self.trees[source] = tree
+                return tree
+
+        tree = self.graph.search(source)
+        with self.lock:
+            while self.trees and len(self.trees) >= self.size:
+                self.trees.popitem(last=False)  # least recently used
+            self.trees[source] = tree
+        return tree
+
+    def min_cost(self, orig, dest):
+        """
+        Takes strings orig, dest (both in graph)
+        Returns (min cost, path-list), (inf, []) if dest is unreachable
+        """
+        if orig == dest:
+            return 0, [orig]
+
+        ids = self.graph.ids
+        source, target = ids.get(orig), ids.get(dest)
+        if source is None or target is None:
+            return _INF_, []
+
+        if self.table is not None:
+            costs, prev = self.table.row(source)
+        elif source in self.trees or (self.size > 0 and not self.algorithm):
+            costs, prev = self.tree(source)
+        else:
+            return self.graph.min_cost(orig, dest,
+                                       self.algorithm or 'dijkstra')
+
+        return self.graph.route(source, target, costs, prev)
+
+
+class RouteTable(object):
+    """
+    Min costs and previous places in the way between all pairs of places in
+    a graph, as places x places matrices by id stored row by row.
+    """
+
+    def __init__(self, graph, costs, prev):
+        self.places = len(graph.names)
+        self.digest = graph.digest()
+        self.costs = costs
+        self.prev = prev
+
+    @classmethod
+    def compute(cls, graph):
+        """Returns the table for graph: computed with Floyd-Warshall when
+        numpy is available and the graph is dense, or with a search from
+        every place otherwise.
+        """
+        # Floyd-Warshall takes places^3 vectorized steps, while searching from
+        # every place takes about places * connections, but in python
+        places = len(graph.names)
+        if len(graph.targets) * 256 >= places ** 2 and \
+           load_numpy() is not None:
+            costs, prev = floyd_warshall(graph)
+            return cls(graph, costs.ravel(), prev.ravel())
+
+        costs, prev = array('d'), array('i')
+        for source in xrange(len(graph.names)):
+            row_costs, row_prev = graph.search(source)
+            costs.extend(row_costs)
+            prev.extend(row_prev)
+        return cls(graph, costs, prev)
+
+    def row(self, source):
+        "Returns (costs, prev) for all the places from the source id"
+        start = source * self.places
+        return (self.costs[start:start + self.places],
+                self.prev[start:start + self.places])
+
+    def save(self, path):
+        """Writes the table to path: a json header line followed by the
+        costs (doubles) and previous places (ints) in machine order"""
+        header = {'format': _TABLE_FORMAT_, 'version': _TABLE_VERSION_,
+                  'places': self.places, 'digest': self.digest}
+        with open(path, 'wb') as tfile:
+            tfile.write(json.dumps(header) + '\n')
+            for data in (self.costs, self.prev):
+                tfile.write(data.tostring())
+
+    @classmethod
+    def load(cls, path, graph):
+        """Returns the table saved in path for graph, memory mapped when
+        numpy is available. Returns None if it was saved for another graph.
+        """
+        with open(path, 'rb') as tfile:
+            header = json.loads(tfile.readline())
+            if header.get('format') != _TABLE_FORMAT_ or \
+               header.get('version') != _TABLE_VERSION_ or \
+               header.get('digest') != graph.digest():
+                return
+
+            cells = header['places'] ** 2
+            offset = tfile.tell()
+            if load_numpy() is not None:
+                costs = numpy.memmap(path, numpy.float64, 'r', offset, cells)
+                prev = numpy.memmap(path, numpy.int32, 'r', offset + cells * 8,
+                                    cells)
+            else:
+                costs, prev = array('d'), array('i')
+                costs.fromfile(tfile, cells)
+                prev.fromfile(tfile, cells)
+
+        return cls(graph, costs, prev)
+
+
+def floyd_warshall(graph):
+    """
+    Returns (costs, prev) places x places numpy matrices with the min cost
+    and the previous place in the way between all pairs of places.
+    Every place is tried as a stop for every pair at once.
+    """
+    places = len(graph.names)
+    costs = numpy.full((places, places), _INF_)
+    prev = numpy.full((places, places), -1, numpy.int32)
+
+    offsets = numpy.frombuffer(graph.offsets, numpy.dtype('l'))
+    origins = numpy.repeat(numpy.arange(places), numpy.diff(offsets))
+    targets = numpy.frombuffer(graph.targets, numpy.int32)
+    numpy.minimum.at(costs, (origins, targets),
+                     numpy.frombuffer(graph.weights, numpy.float64))
+    prev[origins, targets] = origins
+    costs[numpy.diag_indices(places)] = 0
+    prev[numpy.diag_indices(places)] = numpy.arange(places)
+
+    for stop in xrange(places):
+        alt = costs[:, stop, None] + costs[stop]
+        better = alt < costs
+        numpy.copyto(costs, alt, where=better)
+        numpy.copyto(prev, prev[stop], where=better)
+
+    return costs, prev
+
+
+def load_table(path, graph):
+    """Returns the RouteTable for graph saved in path, computing and saving
+    it first if missing or saved for another graph"""
+    try:
+        table = RouteTable.load(path, graph) if os.path.exists(path) else None
+    except (IOError, ValueError), err:
+        error("Couldn't read the routes table {0}: {1}".format(path, err))
+
+    if table is None:
+        logging.info("Computing the routes table for {0} places"
+                     .format(len(graph.names)))
+        table = RouteTable.compute(graph)
+        try:
+            table.save(path)
+        except IOError, err:
+            error("Couldn't write the routes table {0}: {1}"
+                  .format(path, err), is_exit=False)
+
+    return table
+
+
+def init_worker(graph, stops):
+    "Sets the graph and the stops ids for cost_row in a worker process"
+    _WORKER_['graph'] = graph
+    _WORKER_['stops'] = stops
+
+
+def cost_row(source):
+    "Returns the min costs from the source id to every stop id"
+    costs = _WORKER_['graph'].search(source)[0]
+    return [costs[stop] for stop in _WORKER_['stops']]
+
+
+def cost_matrix(routes, stops, jobs=None):
+    """
+    Returns the min costs between every pair of stops names as a list of
+    rows, looked up in the routes table or searched in jobs processes.
+    """
+    graph = routes.graph
+    for stop in stops:
+        if stop not in graph.ids:
+            error("Unknown place {0}".format(stop))
+
+    ids = [graph.ids[stop] for stop in stops]
+    if routes.table is not None:
+        return [[costs[stop] for stop in ids]
+                for costs in (routes.table.row(source)[0] for source in ids)]
+
+    if jobs == 1 or len(ids) < 3:
+        return [[costs[stop] for stop in ids]
+                for costs in (graph.search(source)[0] for source in ids)]
+
+    import multiprocessing
+
+    pool = multiprocessing.Pool(jobs, init_worker, (graph, ids))
+    try:
+        return pool.map(cost_row, ids)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def held_karp(matrix, start, end, middle):
+    """
+    Returns the cheapest order to visit all the middle indexes in matrix,
+    going from start to end, None if there's no way to visit them all.
+    Exact, but takes 2^len(middle) steps.
+    """
+    if load_numpy() is not None:
+        return held_karp_numpy(matrix, start, end, middle)
+
+    stops = len(middle)
+    full = (1 << stops) - 1
+    costs = [[_INF_] * stops for mask in xrange(full + 1)]
+    parents = [[-1] * stops for mask in xrange(full + 1)]
+    for last in xrange(stops):
+        costs[1 << last][last] = matrix[start][middle[last]]
+
+    # Extend every way to visit the stops in mask ending in last with another
+    for mask in xrange(1, full + 1):
+        for last in xrange(stops):
+            cost = costs[mask][last]
+            if cost == _INF_:
+                continue
+            row = matrix[middle[last]]
+            for stop in xrange(stops):
+                if mask & (1 << stop):
+                    continue
+                alt = cost + row[middle[stop]]
+                if alt < costs[mask | (1 << stop)][stop]:
+                    costs[mask | (1 << stop)][stop] = alt
+                    parents[mask | (1 << stop)][stop] = last
+
+    last = min(xrange(stops),
+               key=lambda stop: costs[full][stop] + matrix[middle[stop]][end])
+    return held_karp_order(parents, full, last, middle)
+
+
+def held_karp_numpy(matrix, start, end, middle):
+    """
+    Held-Karp with numpy: the ways to visit every set of stops of the same
+    size are extended at once, in chunks.
+    """
+    stops = len(middle)
+    dist = numpy.array(matrix, numpy.float64)[numpy.ix_(middle, middle)]
+    costs = numpy.full((1 << stops, stops), _INF_)
+    parents = numpy.full((1 << stops, stops), -1, numpy.int8)
+    costs[1 << numpy.arange(stops), numpy.arange(stops)] = \
+        numpy.array(matrix, numpy.float64)[start, middle]
+
+    masks = numpy.arange(1, 1 << stops)
+    sizes = sum((masks >> stop) & 1 for stop in xrange(stops))
+    for size in xrange(1, stops):
+        layer = masks[sizes == size]
+        for chunk in xrange(0, len(layer), 4096):
+            mask = layer[chunk:chunk + 4096]
+            alt = costs[mask][:, :, None] + dist[None]  # mask, last, next
+            best = alt.argmin(axis=1)
+            alt = alt.min(axis=1)
+            for stop in xrange(stops):
+                todo = (mask & (1 << stop)) == 0
+                extended = mask[todo] | (1 << stop)
+                better = alt[todo, stop] < costs[extended, stop]
+                costs[extended[better], stop] = alt[todo, stop][better]
+                parents[extended[better], stop] = best[todo, stop][better]
+
+    full = (1 << stops) - 1
+    ends = numpy.array(matrix, numpy.float64)[middle, end]
+    last = int((costs[full] + ends).argmin())
+    return held_karp_order(parents, full, last, middle)
+
+
+def held_karp_order(parents, mask, last, middle):
+    """Returns the middle indexes in order following parents back from last,
+    None if the way doesn't visit them all"""
+    order = []
+    while last >= 0:
+        order.append(middle[last])
+        mask, last = mask ^ (1 << last), int(parents[mask][last])
+    order.reverse()
+    return order if not mask else None
+
+
+def path_cost(matrix, path):
+    "Returns the cost of visiting the path indexes of matrix in order"
+    return sum(matrix[orig][dest] for orig, dest in zip(path, path[1:]))
+
+
+def improve_order(matrix, path):
+    """
+    Improves in place the order of the path indexes in matrix, leaving its
+    ends in place, until no 2-opt (reversing a part of it) nor or-opt
+    (moving up to 3 consecutive stops elsewhere) move makes it cheaper.
+    Costs may be asymmetric, so reversed parts are costed again.
+    """
+    improved = True
+    while improved:
+        improved = False
+
+        # 2-opt: reverse path[i:j + 1]
+        for i in xrange(1, len(path) - 2):
+            forward = backward = 0
+            for j in xrange(i + 1, len(path) - 1):
+                forward += matrix[path[j - 1]][path[j]]
+                backward += matrix[path[j]][path[j - 1]]
+                before = matrix[path[i - 1]][path[i]] + forward + \
+                    matrix[path[j]][path[j + 1]]
+                after = matrix[path[i - 1]][path[j]] + backward + \
+                    matrix[path[i]][path[j + 1]]
+                if after < before - 1e-9:
+                    path[i:j + 1] = path[i:j + 1][::-1]
+                    improved = True
+                    forward, backward = backward, forward
+
+        # or-opt: move path[i:i + size] between path[j] and path[j + 1]
+        for size in (1, 2, 3):
+            for i in xrange(1, len(path) - size):
+                first, last = path[i], path[i + size - 1]
+                gain = matrix[path[i - 1]][first] + \
+                    matrix[last][path[i + size]] - \
+                    matrix[path[i - 1]][path[i + size]]
+                for j in itertools.chain(xrange(i - 1), xrange(i + size,
+                                                               len(path) - 1)):
+                    cost = matrix[path[j]][first] + \
+                        matrix[last][path[j + 1]] - matrix[path[j]][path[j + 1]]
+                    if cost < gain - 1e-9:
+                        segment = path[i:i + size]
+                        del path[i:i + size]
+                        j = j if j < i else j - size
+                        path[j + 1:j + 1] = segment
+                        improved = True
+                        break
+
+    return path
+
+
+def nearest_order(matrix, start, middle):
+    "Returns the middle indexes visiting the cheapest to reach each time"
+    order, left, last = [], set(middle), start
+    while left:
+        last = min(left, key=lambda stop: matrix[last][stop])
+        left.discard(last)
+        order.append(last)
+    return order
+
+
+def best_order(matrix, free_start=False, free_end=False):
+    """
+    Returns the indexes of the places in matrix in the cheapest order to
+    visit them all, which starts at the first and ends at the last, unless
+    free_start or free_end are set. Exact with up to _EXACT_STOPS_ places to
+    order, or _NUMPY_STOPS_ with numpy, heuristic (nearest place and then
+    2-opt and or-opt) beyond.
+    """
+    places = len(matrix)
+    if places < 2:
+        return range(places)
+
+    # Free ends are a place costing 0 to leave to (or arrive from) anywhere
+    matrix = [list(row) + [_INF_, 0 if free_end else _INF_] for row in matrix]
+    matrix.append([0 if free_start else _INF_] * places + [_INF_, _INF_])
+    matrix.append([_INF_] * (places + 2))
+    start = places if free_start else 0
+    end = places + 1 if free_end else places - 1
+    middle = [place for place in xrange(places) if place not in (start, end)]
+
+    order = []
+    if middle and (len(middle) <= _EXACT_STOPS_ or
+                   len(middle) <= _NUMPY_STOPS_ and load_numpy() is not None):
+        order = held_karp(matrix, start, end, middle)
+
+    if middle and not order:  # too many places, or some are unreachable
+        path = [start] + nearest_order(matrix, start, middle) + [end]
+        order = improve_order(matrix, path)[1:-1]
+
+    return [place for place in [start] + order + [end] if place < places]
+
+
+def load_routes(graph_path, opts):
+    "Returns the Routes for the graph in graph_path, set up as in opts"
+    graph = Graph(graph_path, opts.compiled)
+    table = load_table(opts.table, graph) if opts.table else None
+    if opts.algorithm == 'alt':
+        graph.prepare_landmarks(opts.landmarks)
+    return Routes(graph, opts.cache, table, opts.algorithm)
+
+
+def itinerary(routes, stops, order=False, free_start=False, free_end=False,
+              jobs=None):
+    """
+    Returns the (orig, dest, cost, path) legs visiting stops, in the given
+    order or else in the cheapest one, see best_order.
+    """
+    if order:
+        matrix = cost_matrix(routes, stops, jobs)
+        stops = [stops[i] for i in best_order(matrix, free_start, free_end)]
+
+    return [(orig, dest) + tuple(routes.min_cost(orig, dest))
+            for orig, dest in zip(stops, stops[1:])]
+
+
+class Server(object):
+    """
+    Answers queries in json lines with the routes in a graph, loaded once
+    and reloaded when the graph file changes. Each line is a query:
+
+        {"id": 1, "stops": ["jerez", "nottingham", "london"],
+         "order": false, "free_start": false, "free_end": false}
+
+    answered, not necessarily in order, with its legs and its latency:
+
+        {"id": 1, "cost": 193.5, "ms": 0.4, "legs": [
+            {"from": "jerez", "to": "nottingham", "cost": 153.5,
+             "path": ["jerez", "sevilla", "gatwick", "nottingham"]}, ...]}
+
+    Unreachable routes cost null. {"stats": true} answers the latencies
+    and graph status, and {"reload": true} reloads the graph.
+    """
+
+    def __init__(self, graph_path, opts):
+        self.graph_path = graph_path
+        self.opts = opts
+        self.lock = threading.Lock()  # for routes and metrics
+        self.routes = None
+        self.stamp = None
+        self.failed = None  # stamp of the last file which failed to load
+        self.loaded = None
+        self.reloads = 0
+        self.queries = self.errors = 0
+        self.latencies = deque(maxlen=_LATENCIES_)  # ms, last queries
+        self.slowest = 0.0
+        self.reload()
+        if self.routes is None:
+            error("Couldn't load the graph in {0}".format(graph_path))
+
+    def reload(self):
+        """
+        Loads the graph again, keeping the previous one if it fails, for
+        any reason, as while the file is being written.
+        Queries being answered go on with the graph they started with.
+        Returns True if it was loaded
+        """
+        stamp = None
+        try:
+            stamp = file_stamp(self.graph_path)
+            routes = load_routes(self.graph_path, self.opts)
+        except (Exception, SystemExit), err:
+            # error() exits without a message, having logged it already
+            logging.error("Couldn't reload {0}, keeping the previous graph{1}"
+                          .format(self.graph_path, ": {0}".format(err)
+                                  if str(err) else ""))
+            self.failed = stamp
+            return False
+
+        with self.lock:
+            self.reloads += self.routes is not None
+            self.routes, self.stamp, self.loaded = routes, stamp, time.time()
+        logging.info("Loaded {0}: {1} places".format(self.graph_path,
+                                                     len(routes.graph.names)))
+        return True
+
+    def watch(self, interval):
+        """Reloads the graph whenever its file changes, checking every
+        interval. A file which failed to load is tried again once it changes
+        """
+        while True:
+            time.sleep(interval)
+            try:
+                stamp = file_stamp(self.graph_path)
+            except OSError:
+                continue
+            if stamp != self.stamp and stamp != self.failed:
+                self.reload()
+
+    def answer(self, query):
+        "Returns the answer to a query, both dicts"
+        if query.get('stats'):
+            return self.stats()
+        if query.get('reload'):
+            return {'reloaded': self.reload()}
+
+        stops = query.get('stops')
+        if not isinstance(stops, list) or len(stops) < 2:
+            raise ValueError("stops should be a list of two places or more")
+
+        routes = self.routes
+        if query.get('order'):
+            unknown = [stop for stop in stops if stop not in routes.graph.ids]
+            if unknown:
+                raise ValueError("Unknown places: {0}".format(unknown))
+
+        legs = itinerary(routes, stops, query.get('order'),
+                         query.get('free_start'), query.get('free_end'),
+                         jobs=1)
+        total = sum(cost for orig, dest, cost, path in legs)
+        return {'cost': total if total < _INF_ else None,
+                'legs': [{'from': orig, 'to': dest,
+                          'cost': cost if cost < _INF_ else None,
+                          'path': path} for orig, dest, cost, path in legs]}
+
+    def respond(self, line):
+        "Returns the json line answering the json line query"
+        start = time.time()
+        query = dict()
+        try:
+            query = json.loads(line)
+            if not isinstance(query, dict):
+                query = dict()
+                raise ValueError("queries should be objects")
+            response = self.answer(query)
+        except Exception, err:
+            response = {'error': str(err)}
+
+        elapsed = (time.time() - start) * 1000
+        with self.lock:
+            self.queries += 1
+            self.errors += 'error' in response
+            self.latencies.append(elapsed)
+            self.slowest = max(self.slowest, elapsed)
+
+        response['id'] = query.get('id')
+        response['ms'] = round(elapsed, 3)
+        logging.debug("Query {0} answered in {1:.3f}ms"
+                      .format(response['id'], elapsed))
+        return json.dumps(response) + '\n'
+
+    def stats(self):
+        "Returns the query metrics and the graph status"
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = {'queries': self.queries, 'errors': self.errors,
+                     'max_ms': round(self.slowest, 3),
+                     'places': len(self.routes.graph.names),
+                     'loaded': self.loaded, 'reloads': self.reloads}
+
+        for name, rank in (('p50_ms', 0.5), ('p95_ms', 0.95), ('p99_ms', 0.99)):
+            if latencies:
+                stats[name] = round(latencies[int(rank * (len(latencies) - 1))],
+                                    3)
+        if latencies:
+            stats['mean_ms'] = round(sum(latencies) / len(latencies), 3)
+        return stats
+
+    def serve(self, infile, outfile, pool):
+        """
+        Answers the queries in the lines of infile to outfile with the
+        threads in pool, until infile ends. Waits for all the answers.
+        """
+        lock = threading.Lock()  # for outfile
+
+        def write(response):
+            with lock:
+                outfile.write(response)
+                outfile.flush()
+
+        pending = []
+        for line in iter(infile.readline, ''):
+            if line.strip():
+                pending.append(pool.apply_async(self.respond, (line,),
+                                                callback=write))
+            pending = [result for result in pending if not result.ready()]
+
+        for result in pending:
+            result.wait()
+
+
+def unix_server(path, server, pool):
+    """
+    Returns a server answering the queries of every connection to the unix
+    socket in path with server, in a thread each, through pool.
+    SocketServer is imported here, as only --socket needs it
+    """
+    import SocketServer
+
+    class ServerHandler(SocketServer.StreamRequestHandler):
+        "Answers the queries sent through a socket connection, see Server"
+
+        def handle(self):
+            self.server.travel.serve(self.rfile, self.wfile, self.server.pool)
+
+    class UnixServer(SocketServer.ThreadingMixIn,
+                     SocketServer.UnixStreamServer):
+        "Serves the queries of every connection to a socket in a thread"
+        daemon_threads = True
+
+    listener = UnixServer(path, ServerHandler)
+    listener.travel, listener.pool = server, pool
+    return listener
+
+
+def serve(graph_path, opts):
+    """
+    Serves queries for the graph in graph_path through stdin and stdout, or
+    through the unix socket in opts.socket, answered in opts.jobs threads
+    """
+    server = Server(graph_path, opts)
+    watcher = threading.Thread(target=server.watch, args=(opts.interval,))
+    watcher.daemon = True
+    watcher.start()
+
+    from multiprocessing.pool import ThreadPool
+
+    pool = ThreadPool(opts.jobs)
+    try:
+        if not opts.socket:
+            server.serve(sys.stdin, sys.stdout, pool)
+            return
+
+        if os.path.exists(opts.socket):
+            os.remove(opts.socket)
+        listener = unix_server(opts.socket, server, pool)
+        logging.info("Listening on {0}".format(opts.socket))
+        try:
+            listener.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            listener.server_close()
+            os.remove(opts.socket)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def parse_opts():
     """Parses the command line and checks some values.
     Returns parsed options and positional arguments: (opts, args)"
@@ -129,6 +1618,82 @@ def parse_opts():
                                 - 'other_place': cost
                             """)
 
+    parser.add_option("-c", "--cache", dest="cache", action="store",
+                      type="int", default=64,
+                      help="Shortest paths from the last CACHE origins kept "
+                      "in memory. Default 64")
+
+    parser.add_option("-t", "--table", dest="table", action="store",
+                      default=None,
+                      help="Look all routes up in the table in TABLE, "
+                      "computing it first if missing or outdated. "
+                      "For small and medium graphs")
+
+    parser.add_option("-o", "--order", dest="order", action="store_true",
+                      default=False,
+                      help="Visit the destinations in the cheapest order, "
+                      "from the first to the last one")
+
+    parser.add_option("-S", "--free-start", dest="free_start",
+                      action="store_true", default=False,
+                      help="With --order, start from any of the destinations")
+
+    parser.add_option("-E", "--free-end", dest="free_end",
+                      action="store_true", default=False,
+                      help="With --order, end at any of the destinations")
+
+    parser.add_option("-j", "--jobs", dest="jobs", action="store", type="int",
+                      default=None,
+                      help="Processes searching the costs between "
+                      "destinations for --order, or threads answering "
+                      "queries with --serve. Default one per cpu")
+
+    parser.add_option("-s", "--serve", dest="serve", action="store_true",
+                      default=False,
+                      help="Answer json lines queries from stdin to stdout, "
+                      "see Server, reloading the graph when it changes")
+
+    parser.add_option("-u", "--socket", dest="socket", action="store",
+                      default=None,
+                      help="With --serve, answer queries through the unix "
+                      "socket in SOCKET instead")
+
+    parser.add_option("-i", "--interval", dest="interval", action="store",
+                      type="float", default=2.0,
+                      help="With --serve, seconds between checks for graph "
+                      "changes. Default 2")
+
+    parser.add_option("-a", "--algorithm", dest="algorithm", action="store",
+                      type="choice", choices=_ALGORITHMS_, default=None,
+                      help="Search each route with an algorithm ({0}) "
+                      "instead of finding all the routes from its origin. "
+                      "astar needs coordinates".format("|".join(_ALGORITHMS_)))
+
+    parser.add_option("-l", "--landmarks", dest="landmarks", action="store",
+                      type="int", default=_LANDMARKS_,
+                      help="Landmarks for the alt algorithm. Default {0}"
+                      .format(_LANDMARKS_))
+
+    parser.add_option("-k", "--k-shortest", dest="k_shortest",
+                      action="store", type="int", default=1,
+                      help="Show the K cheapest routes for each leg")
+
+    parser.add_option("-m", "--criteria", dest="criteria", action="store",
+                      default=None,
+                      help="Show the routes for each leg which no other beats "
+                      "in all the comma separated criteria: cost, hops, or "
+                      "any other given to the connections")
+
+    parser.add_option("-L", "--labels", dest="labels", action="store",
+                      type="int", default=_LABELS_,
+                      help="Routes kept for each place with --criteria. "
+                      "Default {0}".format(_LABELS_))
+
+    parser.add_option("-N", "--no-cache", dest="compiled", action="store_false",
+                      default=True,
+                      help="Don't use nor save the compiled graph next to "
+                      "the graph file")
+
     parser.add_option("-v", "--verbose", dest="verbose", action="count",
                       default=0, help="")
 
@@ -147,15 +1712,33 @@ def parse_opts():
 def main():
     opts, args = parse_opts()
 
+    if opts.serve:
+        serve(args.pop(0), opts)
+        return
+
     total = 0.0
-    g = Graph(args.pop(0))
+    routes = load_routes(args.pop(0), opts)
+
+    if opts.k_shortest > 1 or opts.criteria:
+        criteria = opts.criteria.split(',') if opts.criteria else None
+        for orig, dest in zip(args, args[1:]):
+            print orig, dest
+            try:
+                for values, path in alternatives(routes.graph, orig, dest,
+                                                 opts.k_shortest, criteria,
+                                                 opts.labels):
+                    print " ".join("{0}={1}".format(name, value) for name, value
+                                   in zip(criteria or ['cost'], values)), path
+            except ValueError, err:
+                error(err)
+        return
 
-    while len(args) > 1:
-        print args[0], args[1]
-        cost, path = g.min_cost(args[0], args[1])
+    for orig, dest, cost, path in itinerary(routes, args, opts.order,
+                                            opts.free_start, opts.free_end,
+                                            opts.jobs):
+        print orig, dest
         total += cost
         print cost, path
-        args.pop(0)
 
     print "total {0}".format(total)
 